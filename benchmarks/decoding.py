@@ -0,0 +1,82 @@
+"""
+Micro-benchmark of search result post-processing.
+
+Compares the former per-result loop of query_backend (time.strptime,
+strftime and locale.getlocale() for every date, summaries for every
+result) with ResultDecoder and SolrResult, which look up the locale once,
+parse dates by position and only build summaries for rendered results.
+
+Usage: python benchmarks/decoding.py [results] [rendered]
+"""
+import datetime
+import locale
+import random
+import sys
+import time
+import timeit
+
+from trac.search import shorten_result
+
+from tracadvsearch.backend import PySolrSearchBackEnd
+from tracadvsearch.backend import ResultDecoder
+from tracadvsearch.backend import SolrResult
+
+WORDS = ('crash', 'trac', 'search', 'ticket', 'wiki', 'solr', 'index',
+	'query', 'page', 'user', 'error', 'timeout', 'milestone', 'component')
+QUERY = 'crash timeout'
+
+
+def make_docs(count):
+	random.seed(0)
+	docs = []
+	for i in range(count):
+		docs.append({
+			'id': 'ticket_%d' % i,
+			'name': 'Ticket %d' % i,
+			'score': random.random(),
+			'source': 'ticket',
+			'time': '2013-%02d-%02dT12:34:56Z' % (i % 12 + 1, i % 28 + 1),
+			'text': ' '.join(random.choice(WORDS) for _ in range(400)),
+		})
+	return docs
+
+
+def former(docs, rendered):
+	for result in docs:
+		result['title'] = result['name']
+		result['summary'] = shorten_result(result['text'], QUERY.split(), maxlen=500)
+		date = datetime.datetime(*(time.strptime(
+			result['time'], PySolrSearchBackEnd.SOLR_DATE_FORMAT)[0:6]))
+		date = date.strftime(PySolrSearchBackEnd.INPUT_DATE_FORMAT)
+		lang, encoding = locale.getlocale()
+		result['date'] = unicode(date, encoding or 'utf-8')
+		del result['name']
+	for result in docs[:rendered]:
+		result['summary'], result['date']
+
+
+def current(docs, rendered):
+	lang, encoding = locale.getlocale()
+	decoder = ResultDecoder(
+		QUERY, PySolrSearchBackEnd.INPUT_DATE_FORMAT, encoding or 'utf-8')
+	results = []
+	for doc in docs:
+		doc['title'] = doc.pop('name', None)
+		results.append(SolrResult(doc, decoder))
+	for result in results[:rendered]:
+		result['summary'], result['date']
+
+
+def main(count=100, rendered=None):
+	count = int(count)
+	rendered = int(rendered or count)
+	docs = make_docs(count)
+	print '%d results, %d rendered' % (count, rendered)
+	for func in (former, current):
+		timer = timeit.Timer(lambda: func([dict(d) for d in docs], rendered))
+		best = min(timer.repeat(repeat=5, number=20)) / 20
+		print '%-8s %8.2f ms per request' % (func.__name__, best * 1000)
+
+
+if __name__ == '__main__':
+	main(*sys.argv[1:])
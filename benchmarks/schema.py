@@ -0,0 +1,194 @@
+"""
+Benchmark of the Solr schema on a generated corpus.
+
+Indexes the same generated wiki pages and tickets into two Solr cores, one
+using the former schema.xml and one using the current one, through the pysolr
+backend. Reports the index size from the core admin STATUS, the indexing
+throughput and the latency of typical advanced search queries for each.
+A few tickets are longer than 32KB, which the former untokenized `text`
+field may reject or truncate depending on the Solr version.
+
+Both cores must be empty. The former schema can be taken from git:
+
+	git show <rev>:solr/conf/schema.xml
+
+Usage: python benchmarks/schema.py <old_core_url> <new_core_url> [docs]
+"""
+import datetime
+import json
+import random
+import shutil
+import sys
+import tempfile
+import time
+import urllib2
+
+from tracadvsearch.query import parse_query
+
+WORDS = ('crash', 'trac', 'search', 'ticket', 'wiki', 'solr', 'index',
+	'query', 'page', 'user', 'error', 'timeout', 'milestone', 'component',
+	'database', 'upgrade', 'plugin', 'template', 'session', 'permission')
+COMPONENTS = ('web', 'core', 'search', 'admin', 'wiki')
+STATUSES = ('new', 'assigned', 'reopened', 'closed')
+USERS = ('alice', 'bob', 'carol', 'dave')
+
+# share of tickets with a description longer than Lucene's 32KB term limit
+LONG_TICKETS = 0.01
+
+BATCH_SIZE = 100
+QUERY_RUNS = 50
+
+QUERIES = (
+	('crash', 'relevance'),
+	('status:closed timeout error', 'relevance'),
+	('component:web crash', 'newest'),
+	('created:2013-01-01..2013-06-30 database', 'relevance'),
+	('owner:bob milestone:1.2', 'oldest'),
+	('"session timeout"', 'relevance'),
+)
+
+
+def words(count):
+	return ' '.join(random.choice(WORDS) for _ in range(count))
+
+
+def make_docs(count):
+	random.seed(0)
+	start = datetime.datetime(2012, 1, 1)
+	docs = []
+	for i in range(count):
+		created = start + datetime.timedelta(hours=i)
+		if i % 5 == 0:
+			docs.append({
+				'id': 'wiki_Page%d' % i,
+				'source': 'wiki',
+				'name': 'Page%d' % i,
+				'version': 1,
+				'time': created,
+				'author': random.choice(USERS),
+				'text': words(random.randint(50, 2000)),
+				'comment': words(5),
+				'visibility': ['wiki'],
+			})
+			continue
+		owner, reporter = random.choice(USERS), random.choice(USERS)
+		if random.random() < LONG_TICKETS:
+			text = words(8000)
+		else:
+			text = words(random.randint(20, 800))
+		docs.append({
+			'id': 'ticket_%d' % i,
+			'ticket_id': i,
+			'source': 'ticket',
+			'name': words(6),
+			'author': reporter,
+			'owner': owner,
+			'type': random.choice(('defect', 'enhancement', 'task')),
+			'time': created,
+			'changetime': created + datetime.timedelta(days=random.randint(0, 90)),
+			'component': random.choice(COMPONENTS),
+			'severity': 'normal',
+			'priority': random.choice(('minor', 'major', 'critical')),
+			'milestone': random.choice(('1.0', '1.1', '1.2')),
+			'status': random.choice(STATUSES),
+			'resolution': '',
+			'keywords': words(2),
+			'ticket_version': '1.0',
+			'text': text,
+			'visibility': ['ticket', 'user:%s' % owner, 'user:%s' % reporter],
+		})
+	return docs
+
+
+def get_backend(solr_url, path):
+	from trac.test import EnvironmentStub
+	from tracadvsearch import PySolrSearchBackEnd
+
+	env = EnvironmentStub(enable=['tracadvsearch.*'], path=path)
+	env.config.set('pysolr_search_backend', 'solr_url', solr_url)
+	env.config.set('pysolr_search_backend', 'warm_queries', '0')
+	env.config.set('pysolr_search_backend', 'related_count', '0')
+	return PySolrSearchBackEnd(env)
+
+
+def index(backend, docs):
+	"""Index docs in batches, return (seconds, rejected documents)."""
+	from tracadvsearch.advsearch import SearchBackendException
+
+	rejected = 0
+	started = time.time()
+	for offset in range(0, len(docs), BATCH_SIZE):
+		# the plugin builds fresh documents for every batch, so do the same
+		batch = [dict(doc) for doc in docs[offset:offset + BATCH_SIZE]]
+		try:
+			backend.upsert_documents(batch)
+		except SearchBackendException:
+			for doc in batch:
+				try:
+					backend.upsert_documents([dict(doc)])
+				except SearchBackendException:
+					rejected += 1
+	return time.time() - started, rejected
+
+
+def index_size(solr_url):
+	"""Return the size in bytes of the index of a core."""
+	base, core = solr_url.rstrip('/').rsplit('/', 1)
+	fp = urllib2.urlopen(
+		'%s/admin/cores?action=STATUS&core=%s&wt=json' % (base, core))
+	try:
+		status = json.load(fp)
+	finally:
+		fp.close()
+	return status['status'][core]['index']['sizeInBytes']
+
+
+def query_latency(backend, q, sort_order):
+	"""Return the median and 95th percentile latency of a query in ms."""
+	criteria = {
+		'q': q,
+		'query': parse_query(q),
+		'start_points': {},
+		'per_page': 15,
+		'sort_order': sort_order,
+		'ticket_statuses': [
+			{'name': status, 'active': True} for status in STATUSES],
+		'visibility': ['ticket', 'wiki', 'user:bob'],
+	}
+	backend.query_backend(dict(criteria))
+	times = []
+	for _ in range(QUERY_RUNS):
+		started = time.time()
+		backend.query_backend(dict(criteria))
+		times.append((time.time() - started) * 1000)
+	times.sort()
+	return times[len(times) // 2], times[int(len(times) * 0.95)]
+
+
+def run(label, solr_url, docs):
+	path = tempfile.mkdtemp()
+	try:
+		backend = get_backend(solr_url, path)
+		seconds, rejected = index(backend, docs)
+		backend.conn.optimize()
+		print '%s (%s)' % (label, solr_url)
+		print '  indexing:      %8.1f docs/s, %d rejected' % (
+			(len(docs) - rejected) / seconds, rejected)
+		print '  index size:    %8.2f MB' % (index_size(solr_url) / 1048576.0)
+		for q, sort_order in QUERIES:
+			median, p95 = query_latency(backend, q, sort_order)
+			print '  %-45s median %6.2f ms, p95 %6.2f ms' % (
+				'%s (%s)' % (q, sort_order), median, p95)
+	finally:
+		shutil.rmtree(path)
+
+
+def main(old_url, new_url, count=10000):
+	docs = make_docs(int(count))
+	print '%d documents' % len(docs)
+	run('former schema', old_url, docs)
+	run('current schema', new_url, docs)
+
+
+if __name__ == '__main__':
+	main(*sys.argv[1:])
@@ -0,0 +1,48 @@
+"""
+Startup benchmark for the pysolr backend.
+
+Shows that importing the plugin and instantiating its components costs
+nothing until search is used: pysolr is not imported and no thread is
+started. The deferred cost is then paid by the first use of the backend.
+
+Usage: python benchmarks/startup.py [solr_url]
+"""
+import sys
+import threading
+import time
+
+
+def timed(func):
+	started = time.time()
+	result = func()
+	return result, (time.time() - started) * 1000
+
+
+def main(solr_url='http://localhost:8983/solr/'):
+	from trac.test import EnvironmentStub
+
+	threads = threading.activeCount()
+	_, import_ms = timed(lambda: __import__('tracadvsearch'))
+	from tracadvsearch import AdvancedSearchPlugin
+	from tracadvsearch import PySolrSearchBackEnd
+
+	env = EnvironmentStub(enable=['tracadvsearch.*'])
+	env.config.set('pysolr_search_backend', 'solr_url', solr_url)
+
+	def instantiate():
+		AdvancedSearchPlugin(env)
+		return list(AdvancedSearchPlugin(env).providers)
+	_, instantiate_ms = timed(instantiate)
+
+	print 'import tracadvsearch:       %8.2f ms' % import_ms
+	print 'instantiate components:     %8.2f ms' % instantiate_ms
+	print 'pysolr imported:            %8s' % ('pysolr' in sys.modules)
+	print 'threads started:            %8d' % (threading.activeCount() - threads)
+
+	_, first_use_ms = timed(lambda: PySolrSearchBackEnd(env).conn)
+	print 'first use of the backend:   %8.2f ms' % first_use_ms
+	print 'threads started after use:  %8d' % (threading.activeCount() - threads)
+
+
+if __name__ == '__main__':
+	main(*sys.argv[1:])
@@ -0,0 +1,144 @@
+"""
+Admission control for advanced search requests.
+
+Searches are admitted through a global concurrency gate, a lower limit for
+expensive searches, and a per-user token bucket.  Requests which can not be
+admitted after a short, bounded wait raise SearchBusy instead of piling up on
+the search backend.
+"""
+import threading
+import time
+
+
+class SearchBusy(Exception):
+	"""Raised when a search request can not be admitted."""
+
+
+class ConcurrencyGate(object):
+	"""
+	Allow at most `limit` holders at a time. Up to `queue_size` callers may
+	wait `timeout` seconds for a free slot, everyone else is rejected
+	immediately. A limit <= 0 disables the gate.
+	"""
+
+	def __init__(self, limit, queue_size=0, timeout=0):
+		self.limit = limit
+		self.queue_size = queue_size
+		self.timeout = timeout
+		self.active = 0
+		self.waiting = 0
+		self._cond = threading.Condition()
+
+	def acquire(self):
+		if self.limit <= 0:
+			return
+		self._cond.acquire()
+		try:
+			if self.active >= self.limit:
+				self._wait()
+			self.active += 1
+		finally:
+			self._cond.release()
+
+	def _wait(self):
+		if self.waiting >= self.queue_size:
+			raise SearchBusy('too many searches waiting')
+		deadline = time.time() + self.timeout
+		self.waiting += 1
+		try:
+			while self.active >= self.limit:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					raise SearchBusy('timed out waiting for a search slot')
+				self._cond.wait(remaining)
+		finally:
+			self.waiting -= 1
+
+	def release(self):
+		if self.limit <= 0:
+			return
+		self._cond.acquire()
+		try:
+			self.active -= 1
+			self._cond.notify()
+		finally:
+			self._cond.release()
+
+
+class TokenBuckets(object):
+	"""
+	Per-key token buckets holding up to `burst` tokens and refilled at `rate`
+	tokens per second. A rate <= 0 disables rate limiting.
+	"""
+
+	MAX_BUCKETS = 10000
+
+	def __init__(self, rate, burst):
+		self.rate = rate
+		self.burst = max(burst, 1)
+		self._buckets = {}
+		self._lock = threading.Lock()
+
+	def consume(self, key, cost=1):
+		"""Take `cost` tokens from the bucket of `key`, return False if empty."""
+		if self.rate <= 0:
+			return True
+		now = time.time()
+		self._lock.acquire()
+		try:
+			tokens = self._refill(key, now)
+			if tokens < cost:
+				self._buckets[key] = (tokens, now)
+				return False
+			self._buckets[key] = (tokens - cost, now)
+			if len(self._buckets) > self.MAX_BUCKETS:
+				self._prune(now)
+			return True
+		finally:
+			self._lock.release()
+
+	def _refill(self, key, now):
+		tokens, last = self._buckets.get(key, (self.burst, now))
+		return min(self.burst, tokens + (now - last) * self.rate)
+
+	def _prune(self, now):
+		"""Forget buckets which are full again, they behave like new ones."""
+		for key in self._buckets.keys():
+			if self._refill(key, now) >= self.burst:
+				del self._buckets[key]
+
+
+class SearchAdmission(object):
+	"""Admit or reject search requests."""
+
+	def __init__(self, max_concurrent, max_expensive, queue_size,
+			queue_timeout, user_rate, user_burst):
+		self.gate = ConcurrencyGate(max_concurrent, queue_size, queue_timeout)
+		self.expensive_gate = ConcurrencyGate(
+			max_expensive, queue_size, queue_timeout)
+		self.buckets = TokenBuckets(user_rate, user_burst)
+
+	def admit(self, user, expensive=False):
+		"""
+		Return a list of acquired gates which must be passed to release()
+		once the search is done. Raises SearchBusy if the request is rejected.
+		"""
+		if not self.buckets.consume(user, expensive and 2 or 1):
+			raise SearchBusy('search rate limit exceeded')
+
+		gates = [self.gate]
+		if expensive:
+			gates.append(self.expensive_gate)
+		acquired = []
+		try:
+			for gate in gates:
+				gate.acquire()
+				acquired.append(gate)
+		except SearchBusy:
+			self.release(acquired)
+			raise
+		return acquired
+
+	def release(self, gates):
+		for gate in reversed(gates):
+			gate.release()
@@ -6,34 +6,66 @@ This module defines a Trac extension point for the advanced search backend.
 See TracAdvancedSearchBackend for more details.
 """
 
+import cProfile
 import itertools
-from operator import itemgetter
+import math
+import os
 import pkg_resources
 import re
+import time
 
 try:
 	import simplejson as json
 except ImportError:
 	import json
 
+from trac.admin import AdminCommandError
+from trac.admin import IAdminCommandProvider
+from trac.attachment import Attachment
+from trac.attachment import IAttachmentChangeListener
 from trac.perm import IPermissionRequestor
 from trac.ticket.api import ITicketChangeListener
+from trac.ticket.model import Ticket
+from trac.versioncontrol.api import IRepositoryChangeListener
+from trac.versioncontrol.api import RepositoryManager
 from trac.web.chrome import INavigationContributor
 from trac.web.chrome import ITemplateProvider
 from trac.web.main import IRequestHandler
 from trac.wiki.api import IWikiChangeListener
 from trac.wiki.api import IWikiSyntaxProvider
-
+from trac.wiki.api import WikiSystem
+from trac.wiki.model import WikiPage
+
+from admission import SearchAdmission
+from admission import SearchBusy
+from extract import TextExtractor
+from merge import ProviderStream
+from merge import merge_streams
+from profiling import format_report
+from query import parse_query
+from saved import SavedSearch
+from saved import SavedSearchMatcher
+from saved import add_new_match
+from workers import WorkerPool
+from workers import is_trac_admin
 from genshi.builder import tag, Element
+from genshi.filters.transform import Transformer
 from interface import IAdvSearchBackend
+from trac.cache import cached
 from trac.core import Component
 from trac.core import ExtensionPoint
 from trac.core import implements
 from trac.mimeview import Context
+from trac.resource import ResourceNotFound
 from trac.util.html import html
 from trac.util.presentation import Paginator
+from trac.util.text import printout
 from trac.util.translation import _
-from trac.web.chrome import add_stylesheet, add_warning, add_script
+from trac.web.api import HTTPServiceUnavailable
+from trac.web.api import ITemplateStreamFilter
+from trac.web.api import RequestDone
+from trac.web.chrome import Chrome
+from trac.web.chrome import add_notice, add_stylesheet, add_warning, add_script
 from trac.wiki.formatter import extract_link
 
 import operator
@@ -56,6 +88,86 @@ CONFIG_FIELD = {
 		'ticket_status_enable',
 		'new, assigned, reopened',
 	),
+	'restricted_components': (
+		CONFIG_SECTION_NAME,
+		'restricted_components',
+		'',
+	),
+	'extraction_workers': (
+		CONFIG_SECTION_NAME,
+		'extraction_workers',
+		2,
+	),
+	'extraction_queue_size': (
+		CONFIG_SECTION_NAME,
+		'extraction_queue_size',
+		100,
+	),
+	'attachment_max_size': (
+		CONFIG_SECTION_NAME,
+		'attachment_max_size',
+		1048576,
+	),
+	'attachment_cache_dir': (
+		CONFIG_SECTION_NAME,
+		'attachment_cache_dir',
+		'cache/advsearch/attachments',
+	),
+	'sync_batch_size': (
+		CONFIG_SECTION_NAME,
+		'sync_batch_size',
+		1000,
+	),
+	'score_normalization': (
+		CONFIG_SECTION_NAME,
+		'score_normalization',
+		'rrf',
+	),
+	'max_per_page': (
+		CONFIG_SECTION_NAME,
+		'max_per_page',
+		100,
+	),
+	'max_concurrent_searches': (
+		CONFIG_SECTION_NAME,
+		'max_concurrent_searches',
+		8,
+	),
+	'max_concurrent_expensive_searches': (
+		CONFIG_SECTION_NAME,
+		'max_concurrent_expensive_searches',
+		2,
+	),
+	'search_queue_size': (
+		CONFIG_SECTION_NAME,
+		'search_queue_size',
+		16,
+	),
+	'search_queue_timeout': (
+		CONFIG_SECTION_NAME,
+		'search_queue_timeout',
+		2.0,
+	),
+	'user_search_rate': (
+		CONFIG_SECTION_NAME,
+		'user_search_rate',
+		1.0,
+	),
+	'user_search_burst': (
+		CONFIG_SECTION_NAME,
+		'user_search_burst',
+		5,
+	),
+	'expensive_per_page': (
+		CONFIG_SECTION_NAME,
+		'expensive_per_page',
+		50,
+	),
+	'expensive_start': (
+		CONFIG_SECTION_NAME,
+		'expensive_start',
+		500,
+	),
 }
 
 # --- any() from Python 2.5 ---
@@ -83,6 +195,15 @@ def _get_config_values(config, option_name):
 	return [value.strip() for value in values.split(',')]
 
 
+def _get_config_pairs(config, option_name):
+	"""Return a list of (name, value) tuples from a 'name:value, ...' option."""
+	return [
+		tuple(part.strip() for part in value.rsplit(':', 1))
+		for value in _get_config_values(config, option_name)
+		if ':' in value
+	]
+
+
 class SearchBackendException(Exception):
 	"""
 	Raised by SearchBackends when there is a problem completing the search
@@ -92,10 +213,14 @@ class SearchBackendException(Exception):
 
 class AdvancedSearchPlugin(Component):
 	implements(
+		IAdminCommandProvider,
+		IAttachmentChangeListener,
 		INavigationContributor,
 		IPermissionRequestor,
+		IRepositoryChangeListener,
 		IRequestHandler,
 		ITemplateProvider,
+		ITemplateStreamFilter,
 		ITicketChangeListener,
 		IWikiChangeListener,
 		IWikiSyntaxProvider,
@@ -105,6 +230,65 @@ class AdvancedSearchPlugin(Component):
 
 	DEFAULT_PER_PAGE = 15
 
+	# switches to profile a request, for TRAC_ADMIN only
+	PROFILE_ARG = 'advsearch_profile'
+	PROFILE_HEADER = 'X-AdvSearch-Profile'
+
+	# session attributes holding saved searches and their new matches
+	SAVED_SEARCHES_ATTR = 'advsearch.saved_searches'
+	NEW_MATCHES_ATTR = 'advsearch.saved_search_matches'
+
+	# document fields kept with new matches to link to the document
+	HREF_FIELDS = (
+		'ticket_id', 'parent_realm', 'parent_id', 'repository', 'revision')
+
+	# documents waiting for their new matches to be recorded
+	MATCH_QUEUE_SIZE = 1000
+
+	# permission needed to see the documents of each realm
+	REALM_PERMISSIONS = {
+		'wiki': 'WIKI_VIEW',
+		'ticket': 'TICKET_VIEW',
+		'milestone': 'MILESTONE_VIEW',
+		'changeset': 'CHANGESET_VIEW',
+	}
+
+	# ticket fields the visibility keys of the ticket's attachments depend on
+	TICKET_VISIBILITY_FIELDS = frozenset(('component', 'owner', 'reporter'))
+
+	# name of the per repository high-water mark of the changeset sync
+	SYNC_REV_KEY = 'advsearch_synced_rev'
+
+	# sources indexed again by the reindex command, in order
+	REINDEX_SOURCES = ('wiki', 'ticket', 'attachment', 'changeset')
+
+	# a term starting with a wildcard, e.g. "*foo" or "?oo"
+	LEADING_WILDCARD_RE = re.compile(r'(?:^|[\s(:])[*?][^\s*?:]')
+
+	def __init__(self):
+		self.admission = SearchAdmission(
+			self.config.getint(*CONFIG_FIELD['max_concurrent_searches']),
+			self.config.getint(*CONFIG_FIELD['max_concurrent_expensive_searches']),
+			self.config.getint(*CONFIG_FIELD['search_queue_size']),
+			self.config.getfloat(*CONFIG_FIELD['search_queue_timeout']),
+			self.config.getfloat(*CONFIG_FIELD['user_search_rate']),
+			self.config.getint(*CONFIG_FIELD['user_search_burst']),
+		)
+		self.extraction_pool = WorkerPool(
+			'attachment extraction',
+			self.log,
+			not is_trac_admin() and
+				self.config.getint(*CONFIG_FIELD['extraction_workers']) or 0,
+			self.config.getint(*CONFIG_FIELD['extraction_queue_size']),
+		)
+		# a single thread records new matches, so their writes don't race
+		self.match_pool = WorkerPool(
+			'saved search matches',
+			self.log,
+			not is_trac_admin() and 1 or 0,
+			self.MATCH_QUEUE_SIZE,
+		)
+
 	def _get_source_filters(self):
 		return set(itertools.chain(*(p.get_sources() for p in self.providers)))
 
@@ -136,6 +320,47 @@ class AdvancedSearchPlugin(Component):
 		Build a dict of search criteria from the user and request results from
 		the active AdvancedSearchBackend.
 		"""
+		if self.PROFILE_ARG in req.args or req.get_header(self.PROFILE_HEADER):
+			if 'TRAC_ADMIN' in req.perm:
+				return self._profile_request(req)
+		return self._process_request(req)
+
+	def _profile_request(self, req):
+		"""
+		Process and render the request under a profiler, then add the report
+		to the page, or send it as a file if the switch is set to 'download'.
+		"""
+		mode = req.args.get(self.PROFILE_ARG) or req.get_header(self.PROFILE_HEADER)
+		profile = {'queries': []}
+
+		def run():
+			started = time.time()
+			template, data, content_type = self._process_request(req, profile)
+			profile['process'] = time.time() - started
+			started = time.time()
+			Chrome(self.env).render_template(req, template, data, content_type)
+			profile['render'] = time.time() - started
+			return template, data, content_type
+
+		profiler = cProfile.Profile()
+		template, data, content_type = profiler.runcall(run)
+		report = format_report(profiler, profile)
+
+		if mode == 'download':
+			if isinstance(report, unicode):
+				report = report.encode('utf-8')
+			req.send_response(200)
+			req.send_header('Content-Type', 'text/plain;charset=utf-8')
+			req.send_header('Content-Disposition',
+				'attachment; filename=advsearch-profile.txt')
+			req.send_header('Content-Length', len(report))
+			req.end_headers()
+			req.write(report)
+			raise RequestDone
+		data['profile_report'] = report
+		return template, data, content_type
+
+	def _process_request(self, req, profile=None):
 		req.perm.assert_permission('SEARCH_VIEW')
 
 		try:
@@ -145,6 +370,8 @@ class AdvancedSearchPlugin(Component):
 			self.log.warn('Could not set per_page to %s' %
 					req.args.getfirst('per_page'))
 			per_page = self.DEFAULT_PER_PAGE
+		max_per_page = self.config.getint(*CONFIG_FIELD['max_per_page'])
+		per_page = min(max(per_page, 1), max_per_page)
 
 		try:
 			page = int(req.args.getfirst('page', 1))
@@ -158,12 +385,16 @@ class AdvancedSearchPlugin(Component):
 			'author': [auth for auth in req.args.getlist('author') if auth],
 			'date_start': req.args.getfirst('date_start'),
 			'date_end': req.args.getfirst('date_end'),
-			'q': req.args.get('q'),
+			'q': req.args.getfirst('q'),
+			'query': parse_query(req.args.getfirst('q')),
 			'start_points': StartPoints.parse_args(req.args, self.providers),
 			'per_page': per_page,
 			'sort_order': sort_order,
 			'ticket_statuses': self._get_ticket_statuses(req.args),
+			'visibility': self._get_visibility_keys(req),
+			'profile': profile,
 		}
+		self._process_saved_searches(req, data)
 
 		# Initial page request
 		if not any((data['q'], data['author'], data['date_start'], data['date_end'])):
@@ -174,23 +405,33 @@ class AdvancedSearchPlugin(Component):
 		if quickjump:
 			req.redirect(quickjump)
 
-		# perform query using backend if q is set
-		result_map = {}
-		total_count = 0
-		for provider in self.providers:
-			result_count, result_list = 0, []
-			try:
-				result_count, result_list = provider.query_backend(data)
-			except SearchBackendException, e:
-				add_warning(req, _('SearchBackendException: %s' % e))
-			total_count += result_count
-			result_map[provider.get_name()] = result_list
+		try:
+			gates = self.admission.admit(
+				self._get_admission_key(req),
+				self._is_expensive(data)
+			)
+		except SearchBusy, e:
+			self.log.info('Rejected search from %s: %s' % (req.authname, e))
+			raise HTTPServiceUnavailable(
+				_('Search is busy, please try again in a moment.'))
 
-		if not total_count:
-			return self._send_response(req, data)
+		# perform query using backend if q is set
+		try:
+			streams = self._get_provider_streams(req, data)
+			total_count = sum(stream.total for stream in streams)
+			if not total_count:
+				return self._send_response(req, data)
+
+			results = merge_streams(
+				streams,
+				per_page,
+				sort_order,
+				self.config.get(*CONFIG_FIELD['score_normalization'])
+			)
+		finally:
+			self.admission.release(gates)
 
 		data['page'] = page
-		results = self._merge_results(result_map, per_page)
 		self._add_href_to_results(results)
 		data['results'] = Paginator(
 			results,
@@ -201,7 +442,7 @@ class AdvancedSearchPlugin(Component):
 
 		# pagination next/prev links
 		if data['results'].has_next_page:
-			data['start_points'] = StartPoints.format(results, data['start_points'])
+			data['start_points'] = StartPoints.format(streams)
 
 		return self._send_response(req, data)
 
@@ -223,33 +464,225 @@ class AdvancedSearchPlugin(Component):
 		add_script(req, 'advsearch/js/pikaday.js')
 		return 'advsearch.html', data, None
 
-	def _merge_results(self, result_map, per_page):
+	def _process_saved_searches(self, req, data):
+		"""Save, delete or view saved searches for authenticated users."""
+		data['saved_searches'] = []
+		data['new_matches'] = []
+		data['save_args'] = []
+		if not req.authname or req.authname == 'anonymous':
+			return
+
+		saved = json.loads(req.session.get(self.SAVED_SEARCHES_ATTR, '{}'))
+		new_matches = json.loads(req.session.get(self.NEW_MATCHES_ATTR, '{}'))
+		criteria = self._get_saved_criteria(data)
+		# saving and deleting change the session, so they are only done on
+		# POST requests, which trac checks for a valid __FORM_TOKEN
+		if req.method == 'POST':
+			name = req.args.getfirst('save_name', '').strip()
+			if req.args.get('save_search') and name:
+				saved[name] = criteria
+				new_matches.pop(name, None)
+				self._save_searches(req, saved, new_matches)
+				add_notice(req, _('Saved search "%s".' % name))
+			elif req.args.get('delete_search') and name in saved:
+				del saved[name]
+				new_matches.pop(name, None)
+				self._save_searches(req, saved, new_matches)
+				add_notice(req, _('Deleted search "%s".' % name))
+			req.redirect(req.href.advsearch(**self._get_saved_args(criteria)))
+
+		for key, value in sorted(self._get_saved_args(criteria).iteritems()):
+			if not isinstance(value, list):
+				value = [value]
+			data['save_args'].extend((key, item) for item in value)
+
+		viewed = req.args.getfirst('saved_search')
+		if viewed in new_matches:
+			data['new_matches'] = self._get_visible_matches(
+				new_matches.pop(viewed), data['visibility'])
+			self._add_href_to_results(data['new_matches'])
+			req.session[self.NEW_MATCHES_ATTR] = json.dumps(new_matches)
+
+		for name, criteria in sorted(saved.iteritems()):
+			data['saved_searches'].append({
+				'name': name,
+				'href': self.env.href.advsearch(
+					saved_search=name, **self._get_saved_args(criteria)),
+				'new_count': len(self._get_visible_matches(
+					new_matches.get(name, []), data['visibility'])),
+			})
+
+	def _get_visible_matches(self, matches, keys):
 		"""
-		Merge results from multiple sources by score in each result. Return
-		the search results to display to the user
-
-		Example:
-		[
-			{
-				'title': 'Trac Help',
-				'href': 'http://...',
-				'date': '2011-04-20 12:34:00',
-				'author': 'admin',
-				'summary': '...'
-			},
-			...
-		]
+		Return the new matches sharing a visibility key with the user, the
+		documents are matched against every saved search regardless of who
+		may see them.
+		"""
+		keys = set(keys)
+		return [match for match in matches
+			if keys.intersection(match.get('visibility') or [])]
+
+	def _save_searches(self, req, saved, new_matches):
+		req.session[self.SAVED_SEARCHES_ATTR] = json.dumps(saved)
+		req.session[self.NEW_MATCHES_ATTR] = json.dumps(new_matches)
+		del self.saved_search_matcher
+
+	def _get_saved_criteria(self, data):
+		"""Return the part of the search criteria which is saved."""
+		return {
+			'q': data['q'],
+			'author': data['author'],
+			'source': [f['name'] for f in data['source'] if f['active']],
+			'status': [s['name'] for s in data['ticket_statuses'] if s['active']],
+			'date_start': data['date_start'],
+			'date_end': data['date_end'],
+			'sort_order': data['sort_order'],
+			'per_page': data['per_page'],
+		}
+
+	def _get_saved_args(self, criteria):
+		"""Return the request args which run a saved search."""
+		args = {'page': 1}
+		for key in ('q', 'author', 'date_start', 'date_end', 'sort_order',
+				'per_page'):
+			if criteria.get(key):
+				args[key] = criteria[key]
+		for source in criteria['source']:
+			args[source] = 'on'
+		for status in criteria['status']:
+			args['status_%s' % status] = 'on'
+		return args
+
+	@cached
+	def saved_search_matcher(self, db=None):
+		"""Compile the saved searches of all users into a matcher."""
+		db = db or self.env.get_db_cnx()
+		cursor = db.cursor()
+		cursor.execute("""
+			SELECT sid, value FROM session_attribute
+			WHERE authenticated=1 AND name=%s
+			""", (self.SAVED_SEARCHES_ATTR,))
+		searches = []
+		for sid, value in cursor:
+			try:
+				saved = json.loads(value)
+			except ValueError:
+				continue
+			for name, criteria in saved.iteritems():
+				searches.append(SavedSearch(sid, name, criteria))
+		return SavedSearchMatcher(searches)
+
+	def _match_saved_searches(self, doc):
 		"""
-		# add backend_name as a key to each result and merge lists
-		all_results = []
-		for backend_name, results in result_map.iteritems():
-			for result_dict in results:
-				result_dict['backend_name'] = backend_name
-			all_results.extend(results)
+		Match doc against the saved searches in memory. The matches are
+		recorded by a background thread, off the request.
+		"""
+		matches = {}
+		for search in self.saved_search_matcher.match(doc):
+			matches.setdefault(search.sid, []).append(search.name)
+		if not matches:
+			return
+
+		entry = {
+			'id': doc['id'],
+			'title': doc['name'],
+			'source': doc['source'],
+			'visibility': doc['visibility'],
+		}
+		# the fields _add_href_to_results() needs
+		for field in self.HREF_FIELDS:
+			if field in doc:
+				entry[field] = doc[field]
+		self.match_pool.submit(self._record_new_matches, entry, matches)
+
+	def _record_new_matches(self, entry, matches):
+		"""
+		Add entry to the new matches of the saved searches in matches, a dict
+		of session id to saved search names, in a single transaction.
+		"""
+		sids = sorted(matches)
+		db = self.env.get_db_cnx()
+		cursor = db.cursor()
+		cursor.execute("""
+			SELECT sid, value FROM session_attribute
+			WHERE authenticated=1 AND name=%%s AND sid IN (%s)
+			""" % ','.join(['%s'] * len(sids)),
+			[self.NEW_MATCHES_ATTR] + sids)
+		values = dict(cursor.fetchall())
+		for sid in sids:
+			try:
+				new_matches = json.loads(values.get(sid) or '{}')
+			except ValueError:
+				new_matches = {}
+			for name in matches[sid]:
+				add_new_match(new_matches, name, entry)
+			if sid in values:
+				cursor.execute("""
+					UPDATE session_attribute SET value=%s
+					WHERE sid=%s AND authenticated=1 AND name=%s
+					""", (json.dumps(new_matches), sid, self.NEW_MATCHES_ATTR))
+			else:
+				cursor.execute("""
+					INSERT INTO session_attribute (sid, authenticated, name, value)
+					VALUES (%s, 1, %s, %s)
+					""", (sid, self.NEW_MATCHES_ATTR, json.dumps(new_matches)))
+		db.commit()
+
+	def _get_admission_key(self, req):
+		"""Rate limit authenticated users by name, anonymous ones by address."""
+		if req.authname and req.authname != 'anonymous':
+			return req.authname
+		return 'anonymous@%s' % req.remote_addr
+
+	def _is_expensive(self, criteria):
+		"""
+		Return True for searches which are known to be costly for the backend:
+		leading wildcards, very deep pages and large pages.
+		"""
+		if criteria['q'] and self.LEADING_WILDCARD_RE.search(criteria['q']):
+			return True
+		if criteria['per_page'] > self.config.getint(
+				*CONFIG_FIELD['expensive_per_page']):
+			return True
+		expensive_start = self.config.getint(*CONFIG_FIELD['expensive_start'])
+		for start in criteria['start_points'].itervalues():
+			try:
+				if int(start) > expensive_start:
+					return True
+			except (TypeError, ValueError):
+				pass
+		return False
 
-		# sort and return results for the page
-		all_results.sort(key=itemgetter('score'), reverse=True)
-		return all_results[:per_page]
+	def _get_provider_streams(self, req, criteria):
+		"""
+		Return a ProviderStream for each provider, starting at its start
+		point. Each provider is first asked for its share of the page.
+		"""
+		providers = list(self.providers)
+		rows = int(math.ceil(float(criteria['per_page']) / max(len(providers), 1)))
+		streams = []
+		for provider in providers:
+			name = provider.get_name()
+			try:
+				start = int(criteria['start_points'].get(name) or 0)
+			except ValueError:
+				start = 0
+			fetch = self._get_fetch(req, provider, criteria)
+			streams.append(ProviderStream(name, fetch, start, rows))
+		return streams
+
+	def _get_fetch(self, req, provider, criteria):
+		"""Return a function querying rows results of provider from start."""
+		def fetch(start, rows):
+			query = dict(criteria)
+			query['per_page'] = rows
+			query['start_points'] = {provider.get_name(): start}
+			try:
+				return provider.query_backend(query)
+			except SearchBackendException, e:
+				add_warning(req, _('SearchBackendException: %s' % e))
+				return 0, []
+		return fetch
 
 	def _add_href_to_results(self, results):
 		"""Add an href key/value to each result dict based on source."""
@@ -258,6 +691,13 @@ class AdvancedSearchPlugin(Component):
 				result['href'] = self.env.href.wiki(result['title'])
 			if result['source'] == 'ticket':
 				result['href'] = self.env.href.ticket(result['ticket_id'])
+			if result['source'] == 'changeset':
+				# solr drops the empty name of the default repository
+				result['href'] = self.env.href.changeset(
+					result['revision'], result.get('repository') or None)
+			if result['source'] == 'attachment':
+				result['href'] = self.env.href.attachment(
+					result['parent_realm'], result['parent_id'], result['title'])
 
 	def _get_filter_dicts(self, req_args):
 		"""Map filters to filter dicts for the frontend."""
@@ -285,13 +725,104 @@ class AdvancedSearchPlugin(Component):
 			})
 		return statuses
 
+	def _get_visibility_keys(self, req):
+		"""
+		Return the sorted visibility keys held by the user of this request.
+		A document is visible when it shares at least one key with the user,
+		see _get_document_visibility(). The user key only matters for tickets
+		in restricted components, without them the keys only depend on the
+		permissions, so backends can cache the filter for all users alike.
+		"""
+		keys = set()
+		for realm, action in self.REALM_PERMISSIONS.iteritems():
+			if action in req.perm:
+				keys.add(realm)
+		restricted = _get_config_pairs(self.config, 'restricted_components')
+		for component, action in restricted:
+			if action in req.perm:
+				keys.add('component:%s' % component)
+		if restricted and req.authname and req.authname != 'anonymous':
+			keys.add('user:%s' % req.authname)
+		return sorted(keys)
+
+	def _get_document_visibility(self, doc):
+		"""
+		Return the visibility keys of a document. Tickets in a restricted
+		component are only visible with the component's permission, or to
+		their owner and reporter. Attachments are visible like their parent.
+		"""
+		realm = doc.get('parent_realm', doc['source'])
+		if realm != 'ticket':
+			return [realm]
+
+		restricted = dict(_get_config_pairs(self.config, 'restricted_components'))
+		if doc.get('component') in restricted:
+			keys = ['component:%s' % doc['component']]
+		else:
+			keys = ['ticket']
+		# the author of an attachment is its uploader, not the reporter
+		if doc['source'] == 'attachment':
+			reporter = doc.get('reporter')
+		else:
+			reporter = doc.get('author')
+		for user in (doc.get('owner'), reporter):
+			if user:
+				keys.append('user:%s' % user)
+		return keys
+
+	def _upsert_document(self, doc):
+		"""Insert or update a document in every search backend."""
+		doc['visibility'] = self._get_document_visibility(doc)
+		try:
+			self._match_saved_searches(doc)
+		except Exception, e:
+			self.log.exception('Could not match saved searches: %s' % e)
+		for provider in self.providers:
+			try:
+				provider.upsert_document(doc)
+			except SearchBackendException, e:
+				self.log.error('SearchBackendException: %s' % e)
+
+	def _upsert_documents(self, docs):
+		"""
+		Insert or update a batch of documents in every search backend. Used
+		to index history, so saved searches are not matched. Return False
+		if a backend failed to store the batch.
+		"""
+		for doc in docs:
+			doc['visibility'] = self._get_document_visibility(doc)
+		success = True
+		for provider in self.providers:
+			try:
+				if hasattr(provider, 'upsert_documents'):
+					provider.upsert_documents(docs)
+				else:
+					for doc in docs:
+						provider.upsert_document(doc)
+			except SearchBackendException, e:
+				self.log.error('SearchBackendException: %s' % e)
+				success = False
+		return success
+
+	def _delete_document(self, identifier):
+		"""Remove a document from every search backend."""
+		for provider in self.providers:
+			try:
+				provider.delete_document(identifier)
+			except SearchBackendException, e:
+				self.log.error('SearchBackendException: %s' % e)
+
 	def _get_quickjump(self, req, query):
 		"""Find quickjump requests if the search comes from the searchbox
 		in the header.  The search is assumed to be from the header searchbox
-		if no page or per_page arguments are found.
+		if no page or per_page arguments are found. Queries with fields are
+		searches, even when they start like a TracLink (milestone:1.2 crash).
 		"""
 		if req.args.get('page') or req.args.get('per_page'):
 			return None
+		parsed = parse_query(query)
+		if parsed.filters or parsed.exclusions or parsed.dates:
+			return None
 
 		link = extract_link(self.env,
 			Context.from_request(req, 'advsearch'), query)
@@ -305,6 +836,52 @@ class AdvancedSearchPlugin(Component):
 	def get_templates_dirs(self):
 		return [pkg_resources.resource_filename(__name__, 'templates')]
 
+	# ITemplateStreamFilter methods
+	def filter_stream(self, req, method, filename, stream, data):
+		if filename != 'ticket.html':
+			return stream
+		ticket = data.get('ticket')
+		if not ticket or not ticket.exists:
+			return stream
+		related = self._get_related_tickets(req, ticket.id)
+		if not related:
+			return stream
+		add_stylesheet(req, 'advsearch/css/advsearch.css')
+		box = tag.div(
+			tag.h3(_('Related tickets')),
+			tag.ul([
+				tag.li(tag.a('#%s' % doc['ticket_id'], ' ', doc['title'],
+					href=req.href.ticket(doc['ticket_id'])))
+				for doc in related
+			]),
+			id='advsearch_related'
+		)
+		return stream | Transformer('//div[@id="ticket"]').after(box)
+
+	def _get_related_tickets(self, req, ticket_id):
+		"""
+		Collect the cached related tickets of the providers, leaving out the
+		ones the user may not see.
+		"""
+		related = []
+		seen = set([ticket_id])
+		for provider in self.providers:
+			if not hasattr(provider, 'get_related_documents'):
+				continue
+			try:
+				docs = provider.get_related_documents('ticket_%s' % ticket_id)
+			except SearchBackendException, e:
+				self.log.warn('Could not get related tickets: %s' % e)
+				continue
+			for doc in docs:
+				if doc['ticket_id'] in seen:
+					continue
+				if 'TICKET_VIEW' not in req.perm('ticket', doc['ticket_id']):
+					continue
+				seen.add(doc['ticket_id'])
+				related.append(doc)
+		return related
+
 	# IWikiSyntaxProvider methods
 	def get_wiki_syntax(self):
 		return []
@@ -317,30 +894,275 @@ class AdvancedSearchPlugin(Component):
 		if query:
 			href = formatter.href.advsearch() + query.replace(' ', '+')
 		else:
-			href = target
+			# [advsearch:"status:closed crash" label], trac removes the quotes,
+			# page keeps it from quickjumping
+			href = formatter.href.advsearch(q=target, page=1)
 		return tag.a(label, class_='search', href=href)
 
+	# IAttachmentChangeListener methods
+	def _attachment_id(self, realm, parent_id, filename):
+		return 'attachment_%s_%s_%s' % (realm, parent_id, filename)
+
+	def attachment_added(self, attachment):
+		self.extraction_pool.submit(
+			self._update_attachment,
+			attachment.parent_realm,
+			attachment.parent_id,
+			attachment.filename
+		)
+
+	def attachment_deleted(self, attachment):
+		self._delete_document(self._attachment_id(
+			attachment.parent_realm, attachment.parent_id, attachment.filename))
+
+	def attachment_reparented(self, attachment, old_parent_realm, old_parent_id):
+		self._delete_document(self._attachment_id(
+			old_parent_realm, old_parent_id, attachment.filename))
+		self.attachment_added(attachment)
+
+	def _update_attachment(self, realm, parent_id, filename):
+		"""Extract the text of an attachment and index it, runs in the pool."""
+		try:
+			attachment = Attachment(self.env, realm, parent_id, filename)
+		except ResourceNotFound:
+			return
+		self._upsert_document(self._get_attachment_doc(attachment))
+
+	def _get_attachment_doc(self, attachment, extractor=None):
+		realm = attachment.parent_realm
+		parent_id = attachment.parent_id
+		filename = attachment.filename
+		fileobj = attachment.open()
+		try:
+			text = (extractor or self._get_text_extractor()).extract(
+				fileobj, filename)
+		finally:
+			fileobj.close()
+
+		doc = {
+			'id': self._attachment_id(realm, parent_id, filename),
+			'source': 'attachment',
+			'name': filename,
+			'author': attachment.author,
+			'time': attachment.date,
+			'text': u'%s %s' % (attachment.description or '', text),
+			'parent_realm': realm,
+			'parent_id': parent_id,
+		}
+		if realm == 'ticket':
+			ticket = Ticket(self.env, parent_id)
+			doc['component'] = ticket['component']
+			doc['owner'] = ticket['owner']
+			doc['reporter'] = ticket['reporter']
+		return doc
+
+	def _get_text_extractor(self):
+		binary_extractor = None
+		for provider in self.providers:
+			binary_extractor = getattr(provider, 'extract_text', None)
+			if binary_extractor:
+				break
+		return TextExtractor(
+			os.path.join(self.env.path,
+				self.config.get(*CONFIG_FIELD['attachment_cache_dir'])),
+			self.config.getint(*CONFIG_FIELD['attachment_max_size']),
+			binary_extractor
+		)
+
+	# IRepositoryChangeListener methods
+	def changeset_added(self, repos, changeset):
+		self._upsert_document(self._get_changeset_doc(repos, changeset))
+
+	def changeset_modified(self, repos, changeset, old_changeset):
+		self.changeset_added(repos, changeset)
+
+	def _get_changeset_doc(self, repos, changeset):
+		rev = unicode(changeset.rev)
+		message = changeset.message or ''
+		return {
+			'id': 'changeset_%s_%s' % (repos.reponame, rev),
+			'source': 'changeset',
+			'name': '[%s] %s' % (
+				repos.display_rev(changeset.rev), message.split('\n', 1)[0]),
+			'text': message,
+			'author': changeset.author,
+			'time': changeset.date,
+			'repository': repos.reponame,
+			'revision': rev,
+		}
+
+	# IAdminCommandProvider methods
+	def get_admin_commands(self):
+		yield ('advsearch sync-changesets', '[repos]',
+			'Index the changesets added since the last sync, of one or all '
+			'repositories',
+			self._complete_repositories, self._do_sync_changesets)
+		yield ('advsearch reindex', '[source ...]',
+			'Index all documents again, or only those of the given sources '
+			'(%s). Used after changing the search schema' %
+				', '.join(self.REINDEX_SOURCES),
+			self._complete_sources, self._do_reindex)
+
+	def _complete_sources(self, args):
+		return [source for source in self.REINDEX_SOURCES if source not in args]
+
+	def _complete_repositories(self, args):
+		if len(args) == 1:
+			return [reponame or '(default)' for reponame, info in
+				RepositoryManager(self.env).get_all_repositories().iteritems()]
+
+	def _do_sync_changesets(self, reponame=None):
+		rm = RepositoryManager(self.env)
+		if reponame is None:
+			# aliases would sync the history of their repository again
+			for repos in self._get_real_repositories():
+				self._sync_changesets(repos)
+			return
+		if reponame == '(default)':
+			reponame = ''
+		repos = rm.get_repository(reponame)
+		if repos is None:
+			printout('Repository "%s" not found' % reponame)
+			return
+		self._sync_changesets(repos)
+
+	def _get_real_repositories(self):
+		"""Return the repositories without aliases, ordered by name."""
+		return sorted(RepositoryManager(self.env).get_real_repositories(),
+			key=lambda repos: repos.reponame)
+
+	def _sync_changesets(self, repos, resync=False):
+		"""
+		Index the history of a repository in batches. The high-water mark is
+		stored after each batch was accepted by every backend, so a failed or
+		interrupted sync continues where it stopped. With resync the whole
+		history is indexed again.
+		"""
+		batch_size = self.config.getint(*CONFIG_FIELD['sync_batch_size'])
+		synced_rev = None
+		if not resync:
+			synced_rev = self._get_synced_rev(repos)
+		if synced_rev is None:
+			rev = repos.oldest_rev
+		else:
+			rev = repos.next_rev(synced_rev)
+
+		count = 0
+		batch = []
+		while rev is not None:
+			batch.append(self._get_changeset_doc(repos, repos.get_changeset(rev)))
+			next_rev = repos.next_rev(rev)
+			if len(batch) >= batch_size or next_rev is None:
+				if not self._upsert_documents(batch):
+					raise AdminCommandError(
+						'%s: could not index the changesets up to %s, see the '
+						'log. Run the sync again to continue.' % (
+							repos.reponame or '(default)', repos.display_rev(rev)))
+				self._set_synced_rev(repos, rev)
+				count += len(batch)
+				printout('%s: indexed %d changesets, up to %s' % (
+					repos.reponame or '(default)', count, repos.display_rev(rev)))
+				batch = []
+			rev = next_rev
+
+	def _do_reindex(self, *sources):
+		for source in sources:
+			if source not in self.REINDEX_SOURCES:
+				raise AdminCommandError('Unknown source "%s", expected one of: %s'
+					% (source, ', '.join(self.REINDEX_SOURCES)))
+		get_docs = {
+			'wiki': self._get_wiki_docs,
+			'ticket': self._get_ticket_docs,
+			'attachment': self._get_attachment_docs,
+		}
+		for source in self.REINDEX_SOURCES:
+			if sources and source not in sources:
+				continue
+			if source == 'changeset':
+				for repos in self._get_real_repositories():
+					self._sync_changesets(repos, resync=True)
+			else:
+				self._reindex(source, get_docs[source]())
+
+	def _reindex(self, source, docs):
+		"""Index documents in batches of sync_batch_size."""
+		batch_size = self.config.getint(*CONFIG_FIELD['sync_batch_size'])
+		count = 0
+		while True:
+			batch = list(itertools.islice(docs, batch_size))
+			if not batch:
+				break
+			if not self._upsert_documents(batch):
+				raise AdminCommandError(
+					'%s: could not index the documents after the first %d, see '
+					'the log' % (source, count))
+			count += len(batch)
+			printout('%s: indexed %d documents' % (source, count))
+
+	def _get_wiki_docs(self):
+		for name in sorted(WikiSystem(self.env).get_pages()):
+			yield self._get_wiki_doc(WikiPage(self.env, name))
+
+	def _get_ticket_docs(self):
+		db = self.env.get_db_cnx()
+		cursor = db.cursor()
+		cursor.execute("SELECT id FROM ticket ORDER BY id")
+		for ticket_id, in cursor.fetchall():
+			yield self._get_ticket_doc(Ticket(self.env, ticket_id))
+
+	def _get_attachment_docs(self):
+		extractor = self._get_text_extractor()
+		db = self.env.get_db_cnx()
+		cursor = db.cursor()
+		cursor.execute("""
+			SELECT type, id, filename FROM attachment ORDER BY type, id, filename
+			""")
+		for realm, parent_id, filename in cursor.fetchall():
+			try:
+				attachment = Attachment(self.env, realm, parent_id, filename)
+				doc = self._get_attachment_doc(attachment, extractor)
+			except (ResourceNotFound, IOError, OSError), e:
+				printout('%s:%s/%s: %s' % (realm, parent_id, filename, e))
+				continue
+			yield doc
+
+	def _get_synced_rev(self, repos):
+		db = self.env.get_db_cnx()
+		cursor = db.cursor()
+		cursor.execute("""
+			SELECT value FROM repository WHERE id=%s AND name=%s
+			""", (repos.id, self.SYNC_REV_KEY))
+		row = cursor.fetchone()
+		if row:
+			return repos.normalize_rev(row[0])
+		return None
+
+	def _set_synced_rev(self, repos, rev):
+		db = self.env.get_db_cnx()
+		cursor = db.cursor()
+		cursor.execute("""
+			DELETE FROM repository WHERE id=%s AND name=%s
+			""", (repos.id, self.SYNC_REV_KEY))
+		cursor.execute("""
+			INSERT INTO repository (id, name, value) VALUES (%s, %s, %s)
+			""", (repos.id, self.SYNC_REV_KEY, unicode(rev)))
+		db.commit()
+
 	# IWikiChangeListener methods
 	def _update_wiki_page(self, page):
+		self._upsert_document(self._get_wiki_doc(page))
+
+	def _get_wiki_doc(self, page):
 		doc = {
 			'source': 'wiki',
 			'id': 'wiki_%s' % page.name,
 		}
 		for prop in ('name', 'version', 'time', 'author', 'text', 'comment'):
 			doc[prop] = getattr(page, prop)
-		for provider in self.providers:
-			try:
-				provider.upsert_document(doc)
-			except SearchBackendException, e:
-				self.log.error('SearchBackendException: %s' % e)
+		return doc
 
 	def _delete_wiki_page(self, name):
-		identifier = 'wiki_%s' % (name)
-		for provider in self.providers:
-			try:
-				provider.delete_document(identifier)
-			except SearchBackendException, e:
-				self.log.error('SearchBackendException: %s' % e)
+		self._delete_document('wiki_%s' % (name))
 
 	wiki_page_added = _update_wiki_page
 	wiki_page_version_deleted = _update_wiki_page
@@ -355,6 +1177,9 @@ class AdvancedSearchPlugin(Component):
 
 	# ITicketChangeListener methods
 	def ticket_created(self, ticket):
+		self._upsert_document(self._get_ticket_doc(ticket))
+
+	def _get_ticket_doc(self, ticket):
 		comments = [
 			change[4] for change in ticket.get_changelog()
 			if change[2] == 'comment'
@@ -382,22 +1207,17 @@ class AdvancedSearchPlugin(Component):
 			'keywords'
 		):
 			doc[prop] = ticket[prop]
-		for provider in self.providers:
-			try:
-				provider.upsert_document(doc)
-			except SearchBackendException, e:
-				self.log.error('SearchBackendException: %s' % e)
+		return doc
 
 	def ticket_deleted(self, ticket):
-		identifier = 'ticket_%s' % (ticket.id)
-		for provider in self.providers:
-			try:
-				provider.delete_document(identifier)
-			except SearchBackendException, e:
-				self.log.error('SearchBackendException: %s' % e)
+		self._delete_document('ticket_%s' % (ticket.id))
 
 	def ticket_changed(self, ticket, comment, author, old_values):
 		self.ticket_created(ticket)
+		# attachments take their visibility keys from the ticket
+		if self.TICKET_VISIBILITY_FIELDS.intersection(old_values or {}):
+			for attachment in Attachment.select(self.env, 'ticket', ticket.id):
+				self.attachment_added(attachment)
 
 	def ticket_comment_modified(self, ticket, cdate, author, comment, old_comment):
 		self.ticket_created(ticket)
@@ -423,25 +1243,14 @@ class StartPoints(object):
 		return start_points
 
 	@classmethod
-	def format(cls, results, prev_start_points):
-		"""Return dict of start_point name to value."""
-		start_points = {}
-		for result in results:
-			backend_name = result['backend_name']
-			if not backend_name in start_points:
-				try:
-					prev_start = int(prev_start_points.get(backend_name, 0))
-				except:
-					prev_start = 0
-				start_points[backend_name] = prev_start
-			start_points[backend_name] += 1
-
+	def format(cls, streams):
+		"""Return the start points of the next page from the merged streams."""
 		return json.dumps(
 			[
 				{
-					'name': cls.FORMAT_STRING % name,
-					'value': value
+					'name': cls.FORMAT_STRING % stream.name,
+					'value': stream.next_start
 				}
-				for (name, value) in start_points.iteritems()
+				for stream in streams
 			]
 		)
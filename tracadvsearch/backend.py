@@ -1,23 +1,43 @@
 """
 Backends for TracAdvancedSearchPlugin which implement IAdvSearchBackend.
 """
+import collections
 import datetime
 import itertools
 import locale
-import pysolr
+import os
 import sys
 import threading
 import time
 import Queue
 from operator import methodcaller
+from StringIO import StringIO
+
+try:
+	import simplejson as json
+except ImportError:
+	import json
 
 from advsearch import SearchBackendException
 from interface import IAdvSearchBackend
 from interface import IIndexer
+from query import parse_query
+from trac.admin import IAdminCommandProvider
 from trac.config import ConfigurationError
 from trac.core import Component
 from trac.core import implements
+from trac.db import Column
+from trac.db import DatabaseManager
+from trac.db import Index
+from trac.db import Table
+from trac.env import IEnvironmentSetupParticipant
 from trac.search import shorten_result
+from trac.util.html import escape
+from trac.util.text import printout
+from workers import is_trac_admin
+
+# imported on first use by PySolrSearchBackEnd._start()
+pysolr = None
 
 CONFIG_SECTION_NAME = 'pysolr_search_backend'
 CONFIG_FIELD = {
@@ -41,8 +61,56 @@ CONFIG_FIELD = {
 		'async_queue_maxsize',
 		0,
 	),
+	'extract_binary': (
+		CONFIG_SECTION_NAME,
+		'extract_binary',
+		False,
+	),
+	'related_count': (
+		CONFIG_SECTION_NAME,
+		'related_count',
+		5,
+	),
+	'related_refresh_rate': (
+		CONFIG_SECTION_NAME,
+		'related_refresh_rate',
+		2.0,
+	),
+	'cache_dir': (
+		CONFIG_SECTION_NAME,
+		'cache_dir',
+		'cache/advsearch',
+	),
+	'query_log_size': (
+		CONFIG_SECTION_NAME,
+		'query_log_size',
+		500,
+	),
+	'warm_queries': (
+		CONFIG_SECTION_NAME,
+		'warm_queries',
+		20,
+	),
+	'warm_interval': (
+		CONFIG_SECTION_NAME,
+		'warm_interval',
+		30,
+	),
 }
 
+# related tickets of each ticket, see NeighborCache
+DB_SCHEMA = [
+	Table('advsearch_related', key=('ticket', 'related'))[
+		Column('ticket', type='int'),
+		Column('related', type='int'),
+		Column('seq', type='int'),
+		Column('title'),
+		Index(['related']),
+	],
+]
+DB_VERSION = 1
+DB_VERSION_KEY = 'advsearch_db_version'
+
 
 def _get_incremental_value(initial, next_, step):
 	""" return incremental value in two stage
@@ -72,16 +140,20 @@ class SolrIndexer(object):
 		self.backend = backend
 
 	def upsert(self, doc):
+		conn = self.backend.conn
 		try:
-			self.backend.conn.add([doc])
+			conn.add([doc])
 		except pysolr.SolrError, e:
 			raise SearchBackendException(e)
+		self.backend._after_upsert([doc])
 
 	def delete(self, identifier):
+		conn = self.backend.conn
 		try:
-			self.backend.conn.delete(id=identifier)
+			conn.delete(id=identifier)
 		except pysolr.SolrError, e:
 			raise SearchBackendException(e)
+		self.backend._after_delete(identifier)
 
 
 class SimpleLifoQueue(list):
@@ -197,6 +269,7 @@ class AsyncSolrIndexer(threading.Thread):
 	def upsert_index(self, doc):
 		self.backend.log.debug('%s: upsert id=%s' % (self._name, doc.get('id')))
 		self.backend.conn.add([doc])
+		self.backend._after_upsert([doc])
 
 	def delete(self, identifier):
 		try:
@@ -207,44 +280,635 @@ class AsyncSolrIndexer(threading.Thread):
 	def delete_index(self, identifier):
 		self.backend.log.debug('%s: delete id=%s' % (self._name, identifier))
 		self.backend.conn.delete(id=identifier)
+		self.backend._after_delete(identifier)
+
+
+class QueryLog(object):
+	"""
+	Rolling, bounded log of the queries sent to Solr. Queries are normalized
+	to their q, fq and sort parameters and ranked by the total time spent
+	on them, so frequent and expensive queries come first.
+	"""
+
+	def __init__(self, maxsize):
+		self.maxsize = maxsize
+		self.entries = {}
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def normalize(q, params):
+		fq = params.get('fq') or []
+		if not isinstance(fq, (list, tuple)):
+			fq = [fq]
+		# uncached filters are per user, replaying them warms nothing
+		fq = [f for f in fq
+			if not f.startswith(PySolrSearchBackEnd.UNCACHED_FILTER)]
+		return {
+			'q': ' '.join(q.split()),
+			'fq': sorted(fq),
+			'sort': params.get('sort'),
+			'rows': params.get('rows'),
+		}
+
+	def record(self, q, params, cost):
+		query = self.normalize(q, params)
+		key = json.dumps([query['q'], query['fq'], query['sort']])
+		self._lock.acquire()
+		try:
+			entry = self.entries.setdefault(
+				key, {'query': query, 'count': 0, 'cost': 0.0})
+			entry['query'] = query
+			entry['count'] += 1
+			entry['cost'] += cost
+			if len(self.entries) > self.maxsize:
+				self._evict()
+		finally:
+			self._lock.release()
+
+	def _evict(self):
+		"""
+		Keep the best ranked three quarters of the log and age them, so
+		queries which stop being used eventually roll out.
+		"""
+		ranked = self._ranked()[:self.maxsize * 3 / 4]
+		self.entries = {}
+		for key, entry in ranked:
+			entry['count'] = max(entry['count'] / 2, 1)
+			entry['cost'] /= 2
+			self.entries[key] = entry
+
+	def _ranked(self):
+		return sorted(
+			self.entries.iteritems(),
+			key=lambda (key, entry): (entry['cost'], entry['count']),
+			reverse=True
+		)
+
+	def top(self, n):
+		"""Return the n best ranked normalized queries."""
+		self._lock.acquire()
+		try:
+			return [entry['query'] for key, entry in self._ranked()[:n]]
+		finally:
+			self._lock.release()
+
+	def load(self, path):
+		try:
+			fp = open(path)
+			try:
+				entries = json.load(fp)
+			finally:
+				fp.close()
+		except (IOError, ValueError):
+			return
+		self._lock.acquire()
+		try:
+			self.entries.update(entries)
+		finally:
+			self._lock.release()
+
+	def dump(self, path):
+		self._lock.acquire()
+		try:
+			data = json.dumps(self.entries)
+		finally:
+			self._lock.release()
+		tmp_path = '%s.tmp' % path
+		fp = open(tmp_path, 'w')
+		try:
+			fp.write(data)
+		finally:
+			fp.close()
+		os.rename(tmp_path, path)
+
+
+class SolrWarmer(threading.Thread):
+	"""
+	Replay the top queries of the query log against Solr after the index
+	changed, so the caches of the new searcher are warm before users hit it.
+	Bursts of commits are coalesced into one warm up every `interval` seconds.
+	"""
+
+	def __init__(self, backend, query_log, count, interval, path):
+		self.backend = backend
+		self.query_log = query_log
+		self.count = count
+		self.interval = interval
+		self.path = path
+		self.pending = threading.Event()
+		threading.Thread.__init__(self)
+		self._name = self.__class__.__name__
+		self.setDaemon(True)
+
+	def schedule(self):
+		if self.count > 0:
+			self.pending.set()
+
+	def run(self):
+		while True:
+			self.pending.wait()
+			time.sleep(self.interval)
+			self.pending.clear()
+			self.warm()
+
+	def warm(self):
+		queries = self.query_log.top(self.count)
+		self.backend.log.debug('%s: warming %d queries' % (self._name, len(queries)))
+		for query in queries:
+			params = {'fl': 'id,score', 'defType': 'edismax'}
+			params.update(self.backend.QUERY_PARAMS)
+			for name in ('fq', 'sort', 'rows'):
+				if query.get(name):
+					params[name] = query[name]
+			try:
+				self.backend.conn.search(query['q'], **params)
+			except Exception, e:
+				self.backend.log.warn('%s: failed to warm query: %s' % (self._name, e))
+				return
+		if not self.path:
+			return
+		try:
+			self.query_log.dump(self.path)
+		except (IOError, OSError), e:
+			self.backend.log.warn('%s: could not save query log: %s' % (self._name, e))
+
+
+class NeighborCache(object):
+	"""
+	The related tickets of each ticket, as lists of [ticket_id, title], in
+	the advsearch_related table. A refresh replaces the rows of one ticket,
+	and the tickets listing a neighbor are found through an index.
+	"""
+
+	def __init__(self, env):
+		self.env = env
+
+	def get(self, ticket_id):
+		db = self.env.get_db_cnx()
+		cursor = db.cursor()
+		cursor.execute("""
+			SELECT related, title FROM advsearch_related
+			WHERE ticket=%s ORDER BY seq
+			""", (int(ticket_id),))
+		return [[related, title] for related, title in cursor.fetchall()]
+
+	def set(self, ticket_id, neighbors):
+		"""Store the neighbors of a ticket, return the previous ones."""
+		old = self.get(ticket_id)
+		db = self.env.get_db_cnx()
+		cursor = db.cursor()
+		cursor.execute("DELETE FROM advsearch_related WHERE ticket=%s",
+			(int(ticket_id),))
+		cursor.executemany("""
+			INSERT INTO advsearch_related (ticket, related, seq, title)
+			VALUES (%s, %s, %s, %s)
+			""", [(int(ticket_id), related, seq, title)
+				for seq, (related, title) in enumerate(neighbors)])
+		db.commit()
+		return old
+
+	def remove(self, ticket_id):
+		"""Forget a ticket, return the tickets which listed it as neighbor."""
+		db = self.env.get_db_cnx()
+		cursor = db.cursor()
+		cursor.execute("""
+			SELECT ticket FROM advsearch_related WHERE related=%s
+			""", (int(ticket_id),))
+		referrers = [row[0] for row in cursor.fetchall()]
+		cursor.execute("""
+			DELETE FROM advsearch_related WHERE ticket=%s OR related=%s
+			""", (int(ticket_id), int(ticket_id)))
+		db.commit()
+		return referrers
+
+
+class NeighborRefresher(threading.Thread):
+	"""
+	Compute the related tickets of indexed tickets in the background, at
+	most `rate` more-like-this queries per second. When the neighbors of a
+	ticket change, the tickets which entered or left its list are refreshed
+	too, without cascading further. Inline refreshers are not started and
+	refresh in the calling thread, which is what short lived trac-admin
+	processes need.
+	"""
+
+	def __init__(self, backend, cache, count, rate, inline=False):
+		self.backend = backend
+		self.cache = cache
+		self.count = count
+		self.rate = rate
+		self.inline = inline
+		self.pending = collections.deque()
+		self.pending_ids = set()
+		self._cond = threading.Condition()
+		threading.Thread.__init__(self)
+		self._name = self.__class__.__name__
+		self.setDaemon(True)
+
+	def schedule(self, ticket_id, cascade=True):
+		if self.inline:
+			self._refresh(ticket_id, cascade)
+			return
+		self._cond.acquire()
+		try:
+			if ticket_id not in self.pending_ids:
+				self.pending_ids.add(ticket_id)
+				self.pending.append((ticket_id, cascade))
+				self._cond.notify()
+		finally:
+			self._cond.release()
+
+	def run(self):
+		while True:
+			self._cond.acquire()
+			try:
+				while not self.pending:
+					self._cond.wait()
+				ticket_id, cascade = self.pending.popleft()
+				self.pending_ids.discard(ticket_id)
+			finally:
+				self._cond.release()
+			self._refresh(ticket_id, cascade)
+			time.sleep(1.0 / self.rate)
+
+	def _refresh(self, ticket_id, cascade):
+		try:
+			self.refresh(ticket_id, cascade)
+		except Exception, e:
+			self.backend.log.warn('%s: could not refresh ticket %s: %s' % (
+				self._name, ticket_id, e))
+
+	def refresh(self, ticket_id, cascade):
+		neighbors = self.backend._more_like_ticket(ticket_id, self.count)
+		old = self.cache.set(ticket_id, neighbors)
+		if cascade:
+			changed = set(n[0] for n in old) ^ set(n[0] for n in neighbors)
+			for other in changed:
+				self.schedule(other, cascade=False)
+
+	def remove(self, ticket_id):
+		for other in self.cache.remove(ticket_id):
+			self.schedule(other, cascade=False)
+
+
+class ResultDecoder(object):
+	"""
+	Turn the fields of solr documents into what the template shows, for
+	the results of one query. The locale encoding is looked up once, and
+	solr dates are parsed by position instead of with time.strptime.
+	"""
+
+	SUMMARY_LENGTH = 500
+
+	def __init__(self, query, date_format, encoding):
+		self.terms = query and query.split() or []
+		self.date_format = date_format
+		self.encoding = encoding
+		self._dates = {}
+
+	def date(self, solr_date):
+		"""Return a human friendly date from a solr date string."""
+		if not solr_date:
+			return u''
+		day = solr_date[:10]
+		if day not in self._dates:
+			# fixed format: 1995-12-31T23:59:59Z
+			date = datetime.date(int(day[0:4]), int(day[5:7]), int(day[8:10]))
+			formatted = date.strftime(self.date_format)
+			if isinstance(formatted, str):
+				formatted = unicode(formatted, self.encoding)
+			self._dates[day] = formatted
+		return self._dates[day]
+
+	def summary(self, text):
+		"""Build a summary which highlights the search terms."""
+		if not text:
+			return ''
+		if not self.terms:
+			return text[:self.SUMMARY_LENGTH]
+		return shorten_result(text, self.terms, maxlen=self.SUMMARY_LENGTH)
+
+
+class SolrResult(dict):
+	"""
+	A search result whose summary and date are computed when they are
+	first read, usually by the template, so results which are fetched but
+	not rendered don't pay for them.
+	"""
+
+	LAZY_FIELDS = {
+		'summary': ('summary', 'text'),
+		'date': ('date', 'time'),
+	}
+
+	def __init__(self, doc, decoder):
+		dict.__init__(self, doc)
+		self.decoder = decoder
+
+	def __missing__(self, key):
+		if key not in self.LAZY_FIELDS:
+			raise KeyError(key)
+		method, field = self.LAZY_FIELDS[key]
+		value = self[key] = getattr(self.decoder, method)(dict.get(self, field))
+		return value
+
+	def get(self, key, default=None):
+		try:
+			return self[key]
+		except KeyError:
+			return default
 
 
 class PySolrSearchBackEnd(Component):
 	"""AdvancedSearchBackend that uses pysolr lib to search Solr."""
-	implements(IAdvSearchBackend)
+	implements(IAdvSearchBackend, IAdminCommandProvider,
+		IEnvironmentSetupParticipant)
 
 	SOLR_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 	INPUT_DATE_FORMAT = "%a %b %d %Y"
 	DEFAULT_DATE_ENCODING = "utf-8"
 
+	# stored fields used to display results
+	RESULT_FIELDS = (
+		'id', 'score', 'name', 'source', 'time', 'author', 'text',
+		'ticket_id', 'status', 'type', 'resolution',
+		'parent_realm', 'parent_id', 'repository', 'revision',
+	)
+
+	# local params of filter queries which must not fill the filter cache
+	UNCACHED_FILTER = '{!cache=false}'
+
 	SPECIAL_CHARACTERS = r'''+-&|!(){}[]^"~*?:\\'''
+	OPERATORS = ('AND', 'OR', 'NOT')
+
+	QUERY_PARAMS = {
+		# favor phrases in the ticket body, exact matches in the name
+		'pf': 'token_text name^2 ticket_id',
+		'qf': 'token_text name^2 ticket_id component milestone keywords',
+	}
 
 	def __init__(self):
+		# connecting to solr and starting threads is deferred to first use,
+		# so trac processes which never search or index don't pay for it
+		self._started = False
+		self._start_lock = threading.Lock()
+		self._neighbor_cache = None
+
+	def _start(self):
+		"""
+		Import pysolr, connect to solr and start the background threads.
+		Failures are raised as SearchBackendException, so they are reported
+		like other backend errors and starting is retried on the next call.
+		"""
+		if self._started:
+			return
+		self._start_lock.acquire()
+		try:
+			if not self._started:
+				try:
+					self._do_start()
+				except (ConfigurationError, ImportError), e:
+					raise SearchBackendException(e)
+				self._started = True
+		finally:
+			self._start_lock.release()
+
+	def _do_start(self):
+		global pysolr
 		solr_url = self.config.get(*CONFIG_FIELD['solr_url'])
 		timeout = self.config.getfloat(*CONFIG_FIELD['timeout'])
 		if not solr_url:
 			raise ConfigurationError('PySolrSearchBackend must be configured in trac.ini')
-		self.conn = pysolr.Solr(solr_url, timeout=timeout)
+		import pysolr
+		self._conn = pysolr.Solr(solr_url, timeout=timeout)
+
+		self._query_log = QueryLog(self.config.getint(*CONFIG_FIELD['query_log_size']))
+		try:
+			query_log_path = self._cache_path('querylog.json')
+		except (IOError, OSError), e:
+			self.log.warn('Query log will not be saved: %s' % e)
+			query_log_path = None
+		else:
+			self._query_log.load(query_log_path)
+		self._warmer = SolrWarmer(
+			self,
+			self._query_log,
+			self.config.getint(*CONFIG_FIELD['warm_queries']),
+			self.config.getint(*CONFIG_FIELD['warm_interval']),
+			query_log_path
+		)
+		self._warmer.start()
+		# warm the caches of a freshly started Solr or worker
+		self._warmer.schedule()
+
+		self._neighbors = None
+		related_count = self.config.getint(*CONFIG_FIELD['related_count'])
+		if related_count > 0:
+			self._neighbors = NeighborRefresher(
+				self,
+				self.neighbor_cache,
+				related_count,
+				self.config.getfloat(*CONFIG_FIELD['related_refresh_rate']),
+				inline=is_trac_admin()
+			)
+			if not self._neighbors.inline:
+				self._neighbors.start()
 
 		self.async_indexing = self.config.getbool(*CONFIG_FIELD['async_indexing'])
 		if self.async_indexing:
 			maxsize = self.config.getint(*CONFIG_FIELD['async_queue_maxsize'])
-			self.indexer = AsyncSolrIndexer(self, maxsize)
-			self.indexer.start()
+			self._indexer = AsyncSolrIndexer(self, maxsize)
+			self._indexer.start()
 		else:
-			self.indexer = SolrIndexer(self)
+			self._indexer = SolrIndexer(self)
+
+	@property
+	def conn(self):
+		self._start()
+		return self._conn
+
+	@property
+	def neighbor_cache(self):
+		"""The related tickets cache, usable without starting the backend."""
+		if self._neighbor_cache is None:
+			self._neighbor_cache = NeighborCache(self.env)
+		return self._neighbor_cache
+
+	@property
+	def indexer(self):
+		self._start()
+		return self._indexer
+
+	@property
+	def query_log(self):
+		self._start()
+		return self._query_log
+
+	@property
+	def warmer(self):
+		self._start()
+		return self._warmer
+
+	def _cache_path(self, filename):
+		"""Return the path of a file in the backend cache directory."""
+		cache_dir = os.path.join(
+			self.env.path, self.config.get(*CONFIG_FIELD['cache_dir']))
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+		return os.path.join(cache_dir, filename)
+
+	# IEnvironmentSetupParticipant methods
+	def environment_created(self):
+		db = self.env.get_db_cnx()
+		self.upgrade_environment(db)
+		db.commit()
+
+	def environment_needs_upgrade(self, db):
+		return self._get_db_version(db) < DB_VERSION
+
+	def upgrade_environment(self, db):
+		cursor = db.cursor()
+		if self._get_db_version(db) < 1:
+			connector, _ = DatabaseManager(self.env)._get_connector()
+			for table in DB_SCHEMA:
+				for statement in connector.to_sql(table):
+					cursor.execute(statement)
+			# rows of the earlier neighbor cache in the system table
+			cursor.execute("""
+				DELETE FROM system WHERE name LIKE %s
+				""", ('advsearch.neighbors.%',))
+			cursor.execute("""
+				INSERT INTO system (name, value) VALUES (%s, %s)
+				""", (DB_VERSION_KEY, str(DB_VERSION)))
+
+	def _get_db_version(self, db):
+		cursor = db.cursor()
+		cursor.execute("""
+			SELECT value FROM system WHERE name=%s
+			""", (DB_VERSION_KEY,))
+		row = cursor.fetchone()
+		return row and int(row[0]) or 0
+
+	# IAdminCommandProvider methods
+	def get_admin_commands(self):
+		yield ('advsearch warming-config', '',
+			'Print a Solr newSearcher listener replaying the top logged queries',
+			None, self._do_warming_config)
+
+	def _do_warming_config(self):
+		printout(self.format_warming_listener())
+
+	def format_warming_listener(self):
+		"""
+		Return a solrconfig.xml newSearcher listener which replays the top
+		queries of the query log, for setups that prefer Solr to warm itself.
+		"""
+		def element(tag, name, value):
+			return '<%s name="%s">%s</%s>' % (
+				tag, name, escape(unicode(value)), tag)
+
+		lines = [
+			'<listener event="newSearcher" class="solr.QuerySenderListener">',
+			'  <arr name="queries">',
+		]
+		for query in self.query_log.top(self.warmer.count):
+			parts = [element('str', 'q', query['q']),
+				element('str', 'defType', 'edismax')]
+			for name, value in sorted(self.QUERY_PARAMS.iteritems()):
+				parts.append(element('str', name, value))
+			for fq in query['fq']:
+				parts.append(element('str', 'fq', fq))
+			if query.get('sort'):
+				parts.append(element('str', 'sort', query['sort']))
+			if query.get('rows'):
+				parts.append(element('int', 'rows', query['rows']))
+			lines.append('    <lst>%s</lst>' % ''.join(parts))
+		lines.extend(['  </arr>', '</listener>'])
+		return '\n'.join(lines)
 
 	def get_name(self):
 		"""Return friendly name for this IAdvSearchBackend provider."""
 		return self.__class__.__name__
 
 	def get_sources(self):
-		return ('wiki', 'ticket')
+		return ('wiki', 'ticket', 'attachment', 'changeset')
+
+	def extract_text(self, content, filename):
+		"""
+		Return the text of a binary file using the Solr extracting request
+		handler, or None when extraction is disabled or fails, so the text
+		is extracted again later.
+		"""
+		if not self.config.getbool(*CONFIG_FIELD['extract_binary']):
+			return None
+		fileobj = StringIO(content)
+		fileobj.name = filename
+		conn = self.conn
+		try:
+			extracted = conn.extract(fileobj, extractFormat='text')
+		except pysolr.SolrError, e:
+			self.log.warn('Could not extract text from %s: %s' % (filename, e))
+			return None
+		return extracted.get('contents') or u''
+
+	def get_related_documents(self, identifier):
+		"""
+		Return the related tickets of a ticket from the neighbor cache in the
+		trac database, without querying solr.
+		"""
+		source, ticket_id = identifier.split('_', 1)
+		if source != 'ticket':
+			return []
+		return [
+			{'source': 'ticket', 'ticket_id': neighbor_id, 'title': title}
+			for neighbor_id, title in self.neighbor_cache.get(ticket_id)
+		]
+
+	def _more_like_ticket(self, ticket_id, count):
+		"""Query solr for the tickets most like a ticket."""
+		results = self.conn.more_like_this(
+			'id:%s' % self._quote('ticket_%s' % ticket_id),
+			'name,token_text',
+			fq='source:"ticket"',
+			fl='ticket_id,name',
+			rows=count,
+			**{'mlt.mintf': 1, 'mlt.mindf': 2}
+		)
+		return [[doc['ticket_id'], doc['name']] for doc in results.docs]
+
+	def _after_upsert(self, docs):
+		"""Warm the new searcher and refresh the neighbors of tickets."""
+		self.warmer.schedule()
+		if self._neighbors:
+			for doc in docs:
+				if doc.get('source') == 'ticket':
+					self._neighbors.schedule(doc['ticket_id'])
+
+	def _after_delete(self, identifier):
+		self.warmer.schedule()
+		if self._neighbors and identifier.startswith('ticket_'):
+			self._neighbors.remove(int(identifier.split('_', 1)[1]))
 
 	def upsert_document(self, doc):
 		doc['time'] = doc['time'].strftime(self.SOLR_DATE_FORMAT)
 		self.indexer.upsert(doc)
 
+	def upsert_documents(self, docs):
+		"""
+		Add a batch of documents with a single request and commit. This is
+		synchronous even with async_indexing, so the caller knows the batch
+		is stored. The documents are not modified, the same batch is passed
+		to every backend.
+		"""
+		docs = [dict(doc, time=doc['time'].strftime(self.SOLR_DATE_FORMAT))
+			for doc in docs]
+		conn = self.conn
+		try:
+			conn.add(docs)
+		except pysolr.SolrError, e:
+			raise SearchBackendException(e)
+		self._after_upsert(docs)
+
 	def delete_document(self, identifier):
 		self.indexer.delete(identifier)
 
@@ -253,15 +917,12 @@ class PySolrSearchBackEnd(Component):
 
 		q = {}
 		params = {
-			'fl': '*,score', # fields returned
+			'fl': ','.join(self.RESULT_FIELDS), # fields returned
 			'rows': criteria.get('per_page', 15),
 			# see https://cwiki.apache.org/confluence/display/solr/The+DisMax+Query+Parser
 			'defType': 'edismax',
-			# favor phrases in the ticket body, exact matches in the name
-			'pf': 'token_text name^2 ticket_id',
-			'qf': 'token_text name^2 ticket_id component milestone keywords',
-
 		}
+		params.update(self.QUERY_PARAMS)
 
 		if criteria.get('sort_order') == 'oldest':
 			params['sort'] = 'time asc'
@@ -270,13 +931,17 @@ class PySolrSearchBackEnd(Component):
 		else: # sort by relevance
 			pass
 
+		if criteria.get('profile') is not None:
+			params['debugQuery'] = 'true'
+
 		# try to find a start offset
 		start_point = criteria['start_points'].get(self.get_name())
 		if start_point:
 			params['start'] = start_point
 
 		# add all fields
-		q['source'] = self._string_from_filters(criteria.get('source')) or '("wiki" OR "ticket")'
+		q['source'] = self._string_from_filters(criteria.get('source')) or \
+			self._string_from_input(self.get_sources())
 		q['author'] = self._string_from_input(criteria.get('author'))
 		q['time'] = self._date_from_range(
 			criteria.get('date_start'),
@@ -288,52 +953,62 @@ class PySolrSearchBackEnd(Component):
 		for k, v in itertools.ifilter(lambda (k, v): v, q.iteritems()):
 			q_parts.append('%s:%s' % (k, v))
 
-		# Ticket only filters
-		status = self._string_from_filters(criteria.get('ticket_statuses'))
-		params['fq'] = '(status:(%s) OR source:"wiki")' % status
+		# fields in the query become separate filters, which solr caches
+		query = criteria.get('query') or parse_query(criteria.get('q'))
+		params['fq'] = self._filters_from_query(query)
 
-		# distribute our search query to several fields
-		if 'q' in criteria and criteria['q']:
-			# edismax handles escaping for us
-			q_parts.append('(%s)' % criteria['q'])
+		# Ticket only filters, unless the query asks for a status
+		if 'status' not in query.filters:
+			status = self._string_from_filters(criteria.get('ticket_statuses'))
+			params['fq'].append('(status:(%s) OR (*:* -source:"ticket"))' % status)
+
+		# one filter per permission set, so it is cached by solr
+		# unless it holds a user key
+		if 'visibility' in criteria:
+			params['fq'].append(self._visibility_filter(criteria['visibility']))
+
+		# distribute the free text of our search query to several fields
+		text = self._string_from_terms(query.terms)
+		if text:
+			q_parts.append('(%s)' % text)
 		else:
 			q_parts.append('*:*')
 
 		q_string = " AND ".join(q_parts)
 
+		conn = self.conn
 		try:
-			results = self.conn.search(q_string, **params)
+			started = time.time()
+			results = conn.search(q_string, **params)
 		except pysolr.SolrError, e:
 			raise SearchBackendException(e)
-		for result in results:
-			result['title'] = result['name']
-			result['summary'] = self._build_summary(result.get('text'), criteria['q'])
-			result['date'] = self._date_from_solr(result['time'])
-			del result['time']
-			del result['name']
-
-		return (results.hits, results.docs)
-
-	def _build_summary(self, text, query):
-		"""Build a summary which highlights the search terms."""
-		if not query:
-			return text[:500]
-		if not text:
-			return ''
-
-		return shorten_result(text, query.split(), maxlen=500)
-
-	def _date_from_solr(self, date_string):
-		"""Return a human friendly date from solr date string."""
-		def safe_decode(date_string):
-			if isinstance(date_string, str):
-				lang, encoding = locale.getlocale()
-				encoding = encoding if encoding else self.DEFAULT_DATE_ENCODING
-				return unicode(date_string, encoding)
-			return date_string
-
-		date = self._strptime(date_string, self.SOLR_DATE_FORMAT)
-		return safe_decode(date.strftime(self.INPUT_DATE_FORMAT))
+		elapsed = time.time() - started
+		self.query_log.record(q_string, params, elapsed)
+		if criteria.get('profile') is not None:
+			criteria['profile']['queries'].append({
+				'provider': self.get_name(),
+				'q': q_string,
+				'fq': params['fq'],
+				'elapsed': elapsed,
+				'qtime': getattr(results, 'qtime', None),
+				'timing': (getattr(results, 'debug', None) or {}).get('timing'),
+			})
+
+		decoder = self._get_result_decoder(' '.join(
+			value for prefix, value, phrase in query.terms if prefix != '-'))
+		docs = []
+		for doc in results.docs:
+			doc['title'] = doc.pop('name', None)
+			docs.append(SolrResult(doc, decoder))
+		return (results.hits, docs)
+
+	def _get_result_decoder(self, query):
+		lang, encoding = locale.getlocale()
+		return ResultDecoder(
+			query,
+			self.INPUT_DATE_FORMAT,
+			encoding or self.DEFAULT_DATE_ENCODING
+		)
 
 	def _string_from_input(self, value):
 		"""Return a value string formatted in solr query syntax."""
@@ -356,6 +1031,104 @@ class PySolrSearchBackEnd(Component):
 		# add filters that are set as active
 		return '("%s")' % ('" OR "'.join(name_list))
 
+	def _filters_from_query(self, query):
+		"""Return canonical filter queries for the fields of a parsed query.
+
+		>>> backend = object.__new__(PySolrSearchBackEnd)
+		>>> q = parse_query('status:new,closed -owner:"bob b" date:2013-05-17')
+		>>> for fq in backend._filters_from_query(q): print fq
+		status:("closed" OR "new")
+		-owner:("bob b")
+		time:[2013-05-17T00:00:00Z TO 2013-05-17T23:59:59Z]
+		>>> backend._filters_from_query(parse_query('modified:2013-05-17..'))
+		['changetime:[2013-05-17T00:00:00Z TO *]']
+		"""
+		filters = []
+		for field, values in sorted(query.filters.iteritems()):
+			filters.append('%s:(%s)' % (
+				field, ' OR '.join(self._quote(value) for value in values)))
+		for field, values in sorted(query.exclusions.iteritems()):
+			filters.append('-%s:(%s)' % (
+				field, ' OR '.join(self._quote(value) for value in values)))
+		for field, (start, end) in sorted(query.dates.iteritems()):
+			filters.append('%s:[%s TO %s]' % (
+				field,
+				start and '%sT00:00:00Z' % start or '*',
+				end and '%sT23:59:59Z' % end or '*',
+			))
+		return filters
+
+	def _string_from_terms(self, terms):
+		"""
+		Return the free text terms of a parsed query for edismax. Parentheses
+		around words group them, unless they are unbalanced.
+
+		>>> backend = object.__new__(PySolrSearchBackEnd)
+		>>> terms = lambda q: backend._string_from_terms(parse_query(q).terms)
+		>>> print terms('-(crash OR hang) +"session timeout" trac*')
+		-(crash OR hang) +"session timeout" trac*
+		>>> print terms('(crash OR hang foo:bar')
+		\\(crash OR hang foo\\:bar
+		>>> print terms('crash) (hang')
+		crash\\) \\(hang
+		>>> print terms('() a!b')
+		\\(\\) a\\!b
+		"""
+		escaped = []
+		grouped = []
+		depth = 0
+		balanced = True
+		for prefix, value, phrase in terms:
+			if phrase:
+				part = prefix + self._quote(value)
+			elif value in self.OPERATORS:
+				part = value
+			else:
+				part = None
+			if part:
+				escaped.append(part)
+				grouped.append(part)
+				continue
+
+			escaped.append(prefix + self._escape(value))
+			word = value.lstrip('(')
+			opening = len(value) - len(word)
+			closing = len(word) - len(word.rstrip(')'))
+			word = word[:len(word) - closing]
+			depth += opening - closing
+			if depth < 0 or (opening and closing and not word):
+				balanced = False
+			grouped.append(
+				prefix + '(' * opening + self._escape(word) + ')' * closing)
+		if balanced and depth == 0:
+			return ' '.join(grouped)
+		return ' '.join(escaped)
+
+	def _escape(self, value):
+		"""Escape solr special characters, except the * and ? wildcards."""
+		return ''.join(
+			c in self.SPECIAL_CHARACTERS and c not in '*?' and '\\' + c or c
+			for c in value
+		)
+
+	def _visibility_filter(self, keys):
+		"""
+		Return a filter query matching documents which share a visibility key
+		with the user. Documents without keys are never matched. A user key
+		makes the filter unique to one user, so it is not cached by solr.
+		"""
+		if not keys:
+			return '(*:* -*:*)'
+		fq = 'visibility:(%s)' % ' OR '.join(
+			self._quote(key) for key in sorted(keys))
+		if [key for key in keys if key.startswith('user:')]:
+			fq = self.UNCACHED_FILTER + fq
+		return fq
+
+	def _quote(self, value):
+		"""Return value as a quoted solr phrase."""
+		return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
 	def _date_from_range(self, start, end):
 		"""Return a date range in solr query syntax."""
 		if not start and not end:
@@ -0,0 +1,88 @@
+"""
+Text extraction for attachments.
+"""
+import hashlib
+import os
+import threading
+
+from trac.mimeview.api import is_binary
+from trac.util.text import to_unicode
+
+
+class TextExtractor(object):
+	"""
+	Extract the text of a file. Files are read in chunks, only the first
+	`max_size` bytes are kept in memory, and the extracted text is cached
+	by content hash. Binary files are passed to `binary_extractor`, a
+	callable taking the content and the filename, when they are not larger
+	than `max_size`. It returns None when it can't extract the text, which
+	is not cached, so the file is extracted again once it can.
+	"""
+
+	CHUNK_SIZE = 64 * 1024
+
+	def __init__(self, cache_dir, max_size, binary_extractor=None):
+		self.cache_dir = cache_dir
+		self.max_size = max_size
+		self.binary_extractor = binary_extractor
+
+	def extract(self, fileobj, filename):
+		digest = hashlib.sha1()
+		chunks = []
+		size = 0
+		binary = None
+		while True:
+			chunk = fileobj.read(self.CHUNK_SIZE)
+			if not chunk:
+				break
+			if binary is None:
+				binary = is_binary(chunk)
+			digest.update(chunk)
+			if size < self.max_size:
+				chunks.append(chunk[:self.max_size - size])
+			size += len(chunk)
+
+		# text cut at max_size is only valid for the same max_size
+		key = digest.hexdigest()
+		if size > self.max_size:
+			key = '%s-%d' % (key, self.max_size)
+		cache_path = os.path.join(self.cache_dir, '%s.txt' % key)
+		text = self._read_cache(cache_path)
+		if text is not None:
+			return text
+
+		content = ''.join(chunks)
+		if not binary:
+			if size > self.max_size:
+				# don't cut a multi-byte character in half
+				content = content[:content.rfind('\n') + 1] or content
+			text = to_unicode(content)
+		elif self.binary_extractor and size <= self.max_size:
+			text = self.binary_extractor(content, filename)
+		else:
+			text = None
+		if text is None:
+			return u''
+		self._write_cache(cache_path, text)
+		return text
+
+	def _read_cache(self, path):
+		try:
+			fp = open(path, 'rb')
+		except IOError:
+			return None
+		try:
+			return fp.read().decode('utf-8')
+		finally:
+			fp.close()
+
+	def _write_cache(self, path, text):
+		if not os.path.isdir(self.cache_dir):
+			os.makedirs(self.cache_dir)
+		tmp_path = '%s.tmp.%s' % (path, threading.currentThread().getName())
+		fp = open(tmp_path, 'wb')
+		try:
+			fp.write(text.encode('utf-8'))
+		finally:
+			fp.close()
+		os.rename(tmp_path, path)
@@ -18,7 +18,14 @@ class IAdvSearchBackend(Interface):
 		Accepts a dictionary doc which contains all the data about an updated
 		document (wiki page, ticket, etc) to be inserted or updated in the 
 		backend index. The keys of the dict should match the field names in
-		the database.
+		the database, plus a 'visibility' list of the permission keys which
+		allow a user to see the document.
+		"""
+
+	def upsert_documents(docs):
+		"""
+		Optional. Insert or update a list of documents at once, used to
+		index history in batches. The documents are stored when it returns.
 		"""
 
 	def delete_document(identifier):
@@ -29,6 +36,20 @@ class IAdvSearchBackend(Interface):
 		"""
 
 
+	def get_related_documents(identifier):
+		"""
+		Optional. Return a list of dicts with the keys source, title and
+		ticket_id of the documents related to a document, from a precomputed
+		cache. Called while rendering ticket pages, it must not query the
+		search service.
+		"""
+
+	def extract_text(content, filename):
+		"""
+		Optional. Return the text of the binary file content, or None when the
+		backend can't extract it. Used to index attachments.
+		"""
+
 	def query_backend(criteria):
 		"""
 		Given a dictionary of criteria, perform a query in the search backend
@@ -36,19 +57,33 @@ class IAdvSearchBackend(Interface):
 		criteria it does not know how to deal with.
 
 		Returns a tuple of (total result count, list of results).  Each results
-		is a dict with keys: title, score, source, summary, date, author. 
-		When multiple providers return results for a source score is used to 
-		order the results. 
+		is a dict with keys: title, score, source, summary, date, author, and
+		optionally time, the date in ISO 8601 format.
+		Results must be sorted by score, or by time for the 'oldest' and
+		'newest' sort orders. When multiple providers return results the
+		per-provider normalized score (or time) is used to merge them, and
+		providers may be queried again from a later start point.
 
 		Example:
 		criteria = {
-			'q': 'trac help',
+			'q': 'trac help status:closed',
+			'query': <ParsedQuery of q, see query.py>,
 			'author: ['admin', 'joe'],
 			'source': ['wiki'],
 			'date_start': '2011-04-01',
 			'date_end': '2011-04-30',
+			'visibility': ['ticket', 'user:joe', 'wiki'],
 		}
 
+		When criteria['profile'] is not None the request is being profiled,
+		and backends may append a dict describing each query they send to
+		criteria['profile']['queries'], with the keys provider, q, fq, elapsed
+		(seconds), qtime and timing.
+
+		Backends should only return documents sharing at least one of the
+		'visibility' keys held by the user, matched against the 'visibility'
+		keys of the documents passed to upsert_document.
+
 		return (
 			200, 
 			[
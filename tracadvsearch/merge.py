@@ -0,0 +1,166 @@
+"""
+Merge the sorted results of several search providers into one page.
+
+Each provider is wrapped in a ProviderStream which fetches its results in
+chunks, only when the merge needs them. Streams are merged with a heap on a
+per-provider normalized score, or on the result date.
+"""
+import heapq
+import math
+import re
+
+# constant of the reciprocal rank fusion, see Cormack et al. 2009
+RRF_K = 60
+
+NON_DIGITS_RE = re.compile(r'\D')
+
+
+def _score(result):
+	return float(result.get('score') or 0)
+
+
+class ProviderStream(object):
+	"""
+	The results of a provider starting at `start`, fetched on demand with
+	fetch(start, rows) which returns a tuple of (total count, results).
+	"""
+
+	def __init__(self, name, fetch, start, rows):
+		self.name = name
+		self.fetch = fetch
+		self.start = start
+		self.consumed = 0
+		self.total = 0
+		self.buffer = []
+		self.offset = start
+		self.stats = None
+		self.exhausted = False
+		self._fill(rows)
+
+	def _fill(self, rows):
+		total, results = self.fetch(self.offset, rows)
+		self.total = total
+		if self.stats is None:
+			self.stats = self._get_stats(results)
+		for result in results:
+			result['backend_name'] = self.name
+		self.buffer.extend(results)
+		self.offset += len(results)
+		if not results or self.offset >= total:
+			self.exhausted = True
+
+	def _get_stats(self, results):
+		"""Score statistics of the first chunk, used for normalization."""
+		scores = [_score(result) for result in results] or [0.0]
+		mean = sum(scores) / len(scores)
+		variance = sum((s - mean) ** 2 for s in scores) / len(scores)
+		return {
+			'min': min(scores),
+			'max': max(scores),
+			'mean': mean,
+			'std': math.sqrt(variance),
+		}
+
+	def next(self, rows):
+		"""
+		Return the next result, fetching up to `rows` results when the
+		buffer is empty, or None when there are no more results.
+		"""
+		if not self.buffer and not self.exhausted:
+			self._fill(max(rows, 1))
+		if not self.buffer:
+			return None
+		return self.buffer.pop(0)
+
+	@property
+	def next_start(self):
+		"""Offset of the first result which was not consumed."""
+		return self.start + self.consumed
+
+
+def normalize_none(stream, result, rank):
+	return _score(result)
+
+
+def normalize_minmax(stream, result, rank):
+	spread = stream.stats['max'] - stream.stats['min']
+	if not spread:
+		return 1.0
+	return (_score(result) - stream.stats['min']) / spread
+
+
+def normalize_zscore(stream, result, rank):
+	if not stream.stats['std']:
+		return 0.0
+	return (_score(result) - stream.stats['mean']) / stream.stats['std']
+
+
+def normalize_rrf(stream, result, rank):
+	return 1.0 / (RRF_K + rank)
+
+
+NORMALIZERS = {
+	'none': normalize_none,
+	'minmax': normalize_minmax,
+	'zscore': normalize_zscore,
+	'rrf': normalize_rrf,
+}
+
+
+def date_key(result):
+	"""Return the ISO 8601 'time' of a result as a sortable integer."""
+	return int(NON_DIGITS_RE.sub('', result.get('time') or '') or 0)
+
+
+def merge_streams(streams, count, sort_order='relevance', normalization='rrf'):
+	"""
+	Return the first `count` results of the merged streams. Results are
+	ordered by descending normalized score, or by date for the 'oldest' and
+	'newest' sort orders. Streams are only read as far as needed.
+
+	>>> def provider(*times):
+	...     docs = [{'id': t, 'time': t} for t in times]
+	...     return lambda start, rows: (len(docs), docs[start:start + rows])
+	>>> a = ProviderStream('a', provider('2013-05-03', '2013-05-01'), 0, 1)
+	>>> b = ProviderStream('b', provider('2013-05-04', '2013-05-02'), 0, 1)
+	>>> [r['id'] for r in merge_streams([a, b], 3, 'newest')]
+	['2013-05-04', '2013-05-03', '2013-05-02']
+	>>> a.next_start, b.next_start
+	(1, 2)
+	>>> a = ProviderStream('a', provider('a1', 'a2', 'a3'), 0, 2)
+	>>> b = ProviderStream('b', provider('b1'), 0, 2)
+	>>> [(r['id'], r['backend_name']) for r in merge_streams([a, b], 3)]
+	[('a1', 'a'), ('b1', 'b'), ('a2', 'a')]
+	>>> a = ProviderStream('a', provider(), 0, 2)
+	>>> merge_streams([a], 3), a.exhausted
+	([], True)
+	"""
+	if sort_order == 'oldest':
+		key = lambda stream, result, rank: date_key(result)
+	elif sort_order == 'newest':
+		key = lambda stream, result, rank: -date_key(result)
+	else:
+		normalize = NORMALIZERS.get(normalization, normalize_rrf)
+		key = lambda stream, result, rank: -normalize(stream, result, rank)
+
+	results = []
+	heap = []
+	ranks = [0] * len(streams)
+
+	def push(index):
+		stream = streams[index]
+		result = stream.next(count - len(results))
+		if result is not None:
+			ranks[index] += 1
+			rank = stream.start + ranks[index]
+			heapq.heappush(heap, (key(stream, result, rank), index, result))
+
+	for index in range(len(streams)):
+		push(index)
+	while heap and len(results) < count:
+		_, index, result = heapq.heappop(heap)
+		streams[index].consumed += 1
+		results.append(result)
+		if len(results) < count:
+			push(index)
+	return results
@@ -0,0 +1,49 @@
+"""
+Reports for profiled advanced search requests.
+"""
+import pstats
+from StringIO import StringIO
+
+# number of functions listed in each section of the report
+REPORT_LINES = 20
+
+
+def flatten_timing(timing, prefix=''):
+	"""
+	Return a list of (name, milliseconds) from the nested 'timing' section
+	of a solr debugQuery response.
+	"""
+	rows = []
+	for name, value in timing.iteritems():
+		if name == 'time':
+			continue
+		if isinstance(value, dict):
+			rows.append(('%s%s' % (prefix, name), value.get('time', 0)))
+			rows.extend(flatten_timing(value, '%s%s.' % (prefix, name)))
+	return sorted(rows)
+
+
+def format_report(profiler, profile):
+	"""
+	Return a text report of the wall times of the request, the solr queries
+	recorded in profile['queries'] by the backends, and the hot functions.
+	"""
+	out = StringIO()
+	out.write('process_request: %8.1f ms\n' % (profile.get('process', 0) * 1000))
+	out.write('render template: %8.1f ms\n\n' % (profile.get('render', 0) * 1000))
+
+	for query in profile['queries']:
+		out.write('%s: %.1f ms, QTime %s ms\n' % (
+			query['provider'], query['elapsed'] * 1000, query.get('qtime')))
+		out.write('  q=%s\n' % query['q'])
+		for fq in query.get('fq') or []:
+			out.write('  fq=%s\n' % fq)
+		for name, ms in flatten_timing(query.get('timing') or {}):
+			out.write('  %-40s %8.1f ms\n' % (name, ms))
+		out.write('\n')
+
+	stats = pstats.Stats(profiler, stream=out)
+	stats.strip_dirs()
+	stats.sort_stats('time').print_stats(REPORT_LINES)
+	stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+	return out.getvalue()
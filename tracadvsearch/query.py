@@ -0,0 +1,176 @@
+"""
+Parse the structured query syntax of the advanced search box.
+
+Known trac fields are turned into filters, everything else is free text:
+
+	status:closed milestone:1.2 owner:bob -type:defect created:2011-04-01..2011-04-30 crash
+
+Values may be quoted (component:"web ui") and hold several alternatives
+separated by commas (status:new,reopened). Repeating a field also adds
+alternatives, a leading - excludes the values instead. Parse results are
+memoized, they must not be modified.
+"""
+import re
+import threading
+import time
+
+# query field name to index field name
+FIELDS = {
+	'status': 'status',
+	'milestone': 'milestone',
+	'component': 'component',
+	'owner': 'owner',
+	'type': 'type',
+	'priority': 'priority',
+	'author': 'author',
+	'reporter': 'author',
+}
+
+DATE_FIELDS = {
+	'date': 'time',
+	'created': 'time',
+	'modified': 'changetime',
+}
+
+DATE_FORMAT = '%Y-%m-%d'
+
+# an optional +/- prefix, an optional field name, and a quoted or bare value
+TOKEN_RE = re.compile(r'''
+	(?P<prefix>[+-]?)
+	(?:(?P<field>\w+):)?
+	(?:"(?P<quoted>(?:[^"\\]|\\.)*)"?|(?P<bare>\S*))
+	''', re.VERBOSE | re.UNICODE)
+
+UNESCAPE_RE = re.compile(r'\\(.)')
+
+CACHE_SIZE = 1000
+
+
+class ParsedQuery(object):
+	"""
+	A parsed query.
+
+	terms - list of (prefix, value, is_phrase) tuples of the free text
+	filters - dict of index field name to a sorted list of values
+	exclusions - dict of index field name to a sorted list of excluded values
+	dates - dict of index field name to a (start, end) tuple of
+		'YYYY-MM-DD' strings, either may be None
+	"""
+
+	def __init__(self, terms, filters, exclusions, dates):
+		self.terms = terms
+		self.filters = filters
+		self.exclusions = exclusions
+		self.dates = dates
+
+	@property
+	def text(self):
+		"""The free text part of the query."""
+		parts = []
+		for prefix, value, phrase in self.terms:
+			if phrase:
+				value = '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+			parts.append(prefix + value)
+		return ' '.join(parts)
+
+
+def _parse_date(value):
+	if not value:
+		return None
+	try:
+		time.strptime(value, DATE_FORMAT)
+	except ValueError:
+		raise ValueError('Invalid date: %s' % value)
+	return value
+
+
+def _parse_date_range(value):
+	"""Return (start, end) from 'start..end', 'start..', '..end' or 'day'."""
+	if '..' in value:
+		start, end = value.split('..', 1)
+	else:
+		start = end = value
+	return _parse_date(start), _parse_date(end)
+
+
+def _parse(q):
+	terms = []
+	filters = {}
+	exclusions = {}
+	dates = {}
+	for match in TOKEN_RE.finditer(q or ''):
+		prefix, field = match.group('prefix'), match.group('field')
+		phrase = match.group('quoted') is not None
+		if phrase:
+			value = UNESCAPE_RE.sub(r'\1', match.group('quoted'))
+		else:
+			value = match.group('bare')
+		if not value:
+			continue
+
+		name = field and field.lower()
+		if name in FIELDS and value:
+			values = phrase and [value] or [v for v in value.split(',') if v]
+			if prefix == '-':
+				target = exclusions
+			else:
+				target = filters
+			target.setdefault(FIELDS[name], set()).update(values)
+			continue
+		if name in DATE_FIELDS and not prefix and not phrase:
+			try:
+				dates[DATE_FIELDS[name]] = _parse_date_range(value)
+				continue
+			except ValueError:
+				pass
+
+		# anything else is free text, unknown fields are searched as words
+		if field and not phrase:
+			value = '%s:%s' % (field, value)
+		terms.append((prefix, value, phrase))
+
+	return ParsedQuery(
+		terms,
+		dict((k, sorted(v)) for k, v in filters.iteritems()),
+		dict((k, sorted(v)) for k, v in exclusions.iteritems()),
+		dates
+	)
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def parse_query(q):
+	"""Return the memoized ParsedQuery of q.
+
+	>>> q = parse_query('status:new,reopened -type:defect reporter:bob crash')
+	>>> sorted(q.filters.items())
+	[('author', ['bob']), ('status', ['new', 'reopened'])]
+	>>> q.exclusions
+	{'type': ['defect']}
+	>>> q.text
+	'crash'
+	>>> q = parse_query('component:"web ui" created:2011-04-01.. date:bad')
+	>>> q.filters, q.dates
+	({'component': ['web ui']}, {'time': ('2011-04-01', None)})
+	>>> q.text
+	'date:bad'
+	>>> parse_query('modified:..2012-01-01').dates
+	{'changetime': (None, '2012-01-01')}
+	>>> parse_query('foo:bar -(crash OR hang) +"session timeout').terms
+	[('', 'foo:bar', False), ('-', '(crash', False), ('', 'OR', False), ('', 'hang)', False), ('+', 'session timeout', True)]
+	>>> parse_query('status: "" -').text
+	''
+	"""
+	parsed = _cache.get(q)
+	if parsed is None:
+		parsed = _parse(q)
+		_cache_lock.acquire()
+		try:
+			if len(_cache) >= CACHE_SIZE:
+				_cache.clear()
+			_cache[q] = parsed
+		finally:
+			_cache_lock.release()
+	return parsed
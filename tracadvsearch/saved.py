@@ -0,0 +1,146 @@
+"""
+Saved searches and incremental matching of newly indexed documents.
+
+Saved searches are compiled into in-memory predicates. Searches with a
+query are indexed under one of their terms, so a document is only checked
+against the searches sharing at least one of its terms, plus the searches
+without a query for its source.
+"""
+import datetime
+import re
+import time
+
+from query import parse_query
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+OPERATORS = frozenset(['and', 'or', 'not', 'to'])
+INPUT_DATE_FORMAT = "%a %b %d %Y"
+
+# number of new matches kept for each saved search
+MAX_NEW_MATCHES = 50
+
+
+def tokenize(text):
+	"""Return the set of lower cased words in text."""
+	if not text:
+		return set()
+	return set(WORD_RE.findall(text.lower()))
+
+
+def query_terms(query):
+	"""
+	Return the terms a document must contain to match the free text of a
+	parsed query. Negated words, wildcards and operators can't be matched
+	exactly and are skipped, so a saved search may match slightly more
+	documents than Solr would.
+	"""
+	terms = set()
+	for prefix, value, phrase in query.terms:
+		if prefix == '-' or '*' in value or '?' in value:
+			continue
+		if ':' in value and not phrase:
+			value = value.split(':', 1)[1]
+		terms.update(tokenize(value))
+	return terms - OPERATORS
+
+
+def _parse_date(date_string, date_format=INPUT_DATE_FORMAT):
+	if not date_string:
+		return None
+	try:
+		return datetime.date(*time.strptime(date_string, date_format)[0:3])
+	except ValueError:
+		return None
+
+
+def _in_range(value, start, end):
+	if not value:
+		return False
+	date = value.date()
+	return not ((start and date < start) or (end and date > end))
+
+
+class SavedSearch(object):
+	"""A saved search compiled into a predicate over indexed documents."""
+
+	def __init__(self, sid, name, criteria):
+		self.sid = sid
+		self.name = name
+		query = parse_query(criteria.get('q'))
+		self.terms = frozenset(query_terms(query))
+		self.filters = [(f, frozenset(v)) for f, v in query.filters.iteritems()]
+		self.exclusions = [(f, frozenset(v)) for f, v in query.exclusions.iteritems()]
+		self.dates = [
+			(field, _parse_date(start, '%Y-%m-%d'), _parse_date(end, '%Y-%m-%d'))
+			for field, (start, end) in query.dates.iteritems()
+		]
+		self.sources = frozenset(criteria.get('source') or ())
+		self.authors = frozenset(a for a in criteria.get('author') or () if a)
+		self.statuses = frozenset(criteria.get('status') or ())
+		self.start = _parse_date(criteria.get('date_start'))
+		self.end = _parse_date(criteria.get('date_end'))
+
+	def matches(self, doc, tokens):
+		if self.sources and doc['source'] not in self.sources:
+			return False
+		if self.authors and doc.get('author') not in self.authors:
+			return False
+		if self.statuses and doc['source'] == 'ticket' and \
+				doc.get('status') not in self.statuses and \
+				not any(field == 'status' for field, values in self.filters):
+			return False
+		if (self.start or self.end) and \
+				not _in_range(doc['time'], self.start, self.end):
+			return False
+		for field, values in self.filters:
+			if doc.get(field) not in values:
+				return False
+		for field, values in self.exclusions:
+			if doc.get(field) in values:
+				return False
+		for field, start, end in self.dates:
+			if not _in_range(doc.get(field), start, end):
+				return False
+		return self.terms.issubset(tokens)
+
+
+class SavedSearchMatcher(object):
+	"""Find the saved searches matching a document."""
+
+	TEXT_FIELDS = ('name', 'text', 'keywords', 'comment')
+
+	def __init__(self, searches):
+		self.by_term = {}
+		self.by_source = {}
+		for search in searches:
+			if search.terms:
+				# longer words tend to be rarer, which keeps candidate lists short
+				term = max(search.terms, key=len)
+				self.by_term.setdefault(term, []).append(search)
+			else:
+				for source in search.sources or (None,):
+					self.by_source.setdefault(source, []).append(search)
+
+	def match(self, doc):
+		"""Return the list of saved searches matching doc."""
+		candidates = self.by_source.get(doc['source'], []) + \
+			self.by_source.get(None, [])
+		tokens = ()
+		if self.by_term:
+			tokens = tokenize(' '.join(
+				doc[field] for field in self.TEXT_FIELDS if doc.get(field)))
+			if len(self.by_term) < len(tokens):
+				for term, searches in self.by_term.iteritems():
+					if term in tokens:
+						candidates.extend(searches)
+			else:
+				for token in tokens:
+					candidates.extend(self.by_term.get(token, ()))
+		return [search for search in candidates if search.matches(doc, tokens)]
+
+
+def add_new_match(new_matches, name, entry):
+	"""Add entry to the new matches of a saved search, newest first."""
+	entries = [e for e in new_matches.get(name, []) if e['id'] != entry['id']]
+	entries.insert(0, entry)
+	new_matches[name] = entries[:MAX_NEW_MATCHES]
@@ -0,0 +1,68 @@
+"""
+A bounded pool of worker threads for background jobs.
+"""
+import Queue
+import sys
+import threading
+
+
+def is_trac_admin():
+	"""Return True when running inside the trac-admin command."""
+	return len(sys.argv) >= 1 and sys.argv[0].find('trac-admin') != -1
+
+
+class WorkerPool(object):
+	"""
+	A fixed number of worker threads consuming jobs from a bounded queue.
+	Threads are started with the first job. With no workers jobs run in the
+	calling thread, which is what short lived trac-admin processes need.
+	Errors are logged with the `name` of the pool.
+	"""
+
+	def __init__(self, name, log, workers, queue_size):
+		self.name = name
+		self.log = log
+		self.workers = workers
+		self.queue = Queue.Queue(queue_size)
+		self.threads = []
+		self._lock = threading.Lock()
+
+	def submit(self, func, *args):
+		"""Queue func(*args), return False if the queue is full."""
+		if self.workers <= 0:
+			self._run(func, args)
+			return True
+		self._start()
+		try:
+			self.queue.put((func, args), block=False)
+		except Queue.Full:
+			self.log.error('%s: Queue is full, cannot put: %s%r' % (
+				self.name, func.__name__, args))
+			return False
+		return True
+
+	def _start(self):
+		self._lock.acquire()
+		try:
+			while len(self.threads) < self.workers:
+				thread = threading.Thread(target=self._work)
+				thread.setDaemon(True)
+				thread.start()
+				self.threads.append(thread)
+		finally:
+			self._lock.release()
+
+	def _work(self):
+		while True:
+			func, args = self.queue.get()
+			try:
+				self._run(func, args)
+			finally:
+				self.queue.task_done()
+
+	def _run(self, func, args):
+		try:
+			func(*args)
+		except Exception, e:
+			self.log.exception('%s: %s%r failed: %s' % (
+				self.name, func.__name__, args, e))